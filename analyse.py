@@ -4,10 +4,24 @@
 
 import sys
 import re
+import time
+import queue
 import multiprocessing as mp
 import datetime
+import email.utils
 import requests
-from bs4 import BeautifulSoup
+from autoindex import streamApacheIndex, streamNGINXIndex
+from dicttools import transverseDict
+from urlfilter import URLFilter
+from packedindex import encodeStamp
+from metrics import registry
+
+# listings stamp to the minute: a directory changed this close to the crawl
+# may still change within the same minute, it is listed again next run
+STAMP_WINDOW = 5 * 60
+# listing stamps are in the server's local time, behind UTC by at most this
+# much; the freshest stamp seen narrows it down (see CrawlState.handle)
+MAX_STAMP_LAG = 12 * 3600
 
 # parse Apache Directory Index table format
 def parseApacheIndex(table):
@@ -54,8 +68,11 @@ def parseNGINXIndex(pre):
     while len(items) > 0:
         entry = dict(template)
         try:
-            # get url from a
-            entry['href'] = items.pop(0).a.get('href')
+            # get url from a (the item is usually the anchor itself)
+            tag = items.pop(0)
+            if tag.name != 'a':
+                tag = tag.a
+            entry['href'] = tag.get('href')
             # get trailing content (timestamp and size)
             trail = items.pop(0).strip()
             for piece in trail.split():
@@ -73,10 +90,10 @@ def parseNGINXIndex(pre):
                     pass
                 entry['size'] = piece
             # guess alt using href same origin relative path
-            if entry['href'].find('/') == 0:
+            if entry['href'].find('/') == 0 or entry['href'] == '../':
                 entry['alt'] = '[PARENTDIR]'
             elif entry['href'].endswith('/'):
-                entry['alt'] = 'DIR'
+                entry['alt'] = '[DIR]'
             entries.append(entry)
         except:
             pass
@@ -97,12 +114,31 @@ def formatIndexEntry(url, entry):
         item['url'] = url + '/' + entry['href']
     return item
 
-def parseIndex(url):
+# "Apache/2.4.38 (Debian)" -> "apache"
+def serverProduct(server):
+    return server.split('/', 1)[0].strip().lower()
+
+def parseIndexContent(url, content_type, server, text):
     index = []
-    r = requests.get(url)
-    if r.headers['Content-Type'].find('text/html') == 0:
-        soup = BeautifulSoup(r.text, 'html.parser')
-        if r.headers['Server'].lower() == 'apache':
+    if content_type.find('text/html') == 0:
+        entries = []
+        if serverProduct(server) == 'apache':
+            entries = streamApacheIndex(text)
+        elif serverProduct(server) == 'nginx':
+            entries = streamNGINXIndex(text)
+        for entry in entries:
+            item = formatIndexEntry(url, entry)
+            if type(item) is dict:
+                index.append(item)
+    return index
+
+# DOM-based reference implementation of parseIndexContent
+def parseIndexContent_Soup(url, content_type, server, text):
+    from bs4 import BeautifulSoup
+    index = []
+    if content_type.find('text/html') == 0:
+        soup = BeautifulSoup(text, 'html.parser')
+        if serverProduct(server) == 'apache':
             for table in soup('table'):
                 try:
                     for entry in parseApacheIndex(table):
@@ -111,7 +147,7 @@ def parseIndex(url):
                             index.append(item)
                 except:
                     pass
-        elif r.headers['Server'].lower() == 'nginx':
+        elif serverProduct(server) == 'nginx':
             for pre in soup('pre'):
                 try:
                     for entry in parseNGINXIndex(pre):
@@ -122,6 +158,27 @@ def parseIndex(url):
                     pass
     return index
 
+def parseIndex(url, session = requests):
+    r = session.get(url, timeout = 120)
+    with registry.timer('parse_duration_seconds'):
+        return parseIndexContent(url, r.headers.get('Content-Type', ''), r.headers.get('Server', ''), r.text)
+
+# conditional GET: returns (status, entries, validators); entries is None on 304
+def fetchIndex(url, session = requests, validators = {}):
+    r = session.get(url, headers = validators, timeout = 120)
+    if r.status_code == 304:
+        return 304, None, { 'date' : r.headers.get('Date') }
+    meta = {
+        'etag' : r.headers.get('ETag'),
+        'last_modified' : r.headers.get('Last-Modified'),
+        'date' : r.headers.get('Date')
+    }
+    # timed here, recorded by CrawlState.handle: workers may be processes
+    start = time.perf_counter()
+    entries = parseIndexContent(url, r.headers.get('Content-Type', ''), r.headers.get('Server', ''), r.text)
+    meta['parse_seconds'] = time.perf_counter() - start
+    return r.status_code, entries, meta
+
 def matchRegex(instr, regexes):
     for regex in regexes:
         if re.search(regex, instr) is not None:
@@ -154,87 +211,200 @@ def recurseIndex(url, whitelist = [], blacklist = []):
             blacklist
         )
 
-def evaluateIndexEntry_ThreadSafe(outQueue, entry, whitelist, blacklist):
-    isWhitelist = len(whitelist) > 0
-    isBlacklist = len(blacklist) > 0
-    if isWhitelist and not matchRegex(entry['url'], whitelist):
-        sys.exit(0)
-    elif isBlacklist and matchRegex(entry['url'], blacklist):
-        sys.exit(0)
+def indexWorker_ThreadSafe(inQueue, outQueue):
+    # long-lived worker: one session (keep-alive) for every listing
+    session = requests.Session()
+    while True:
+        task = inQueue.get(block = True)
+        if task is None:
+            break
+        url, validators = task
+        result = (0, [], {})
+        try:
+            result = fetchIndex(url, session, validators)
+        except Exception as e:
+            print('Failed listing %s: %s' % (url, str(e)))
+        outQueue.put((url,) + result, block = True)
+    session.close()
+    sys.exit(0)
+
+# store file entry in directory-oriented indices
+def insertIndexEntry(indices, url, entry):
+    path = entry['url']
+    if url.endswith('/'):
+        path = path.removeprefix(url)
     else:
-        if 'file' in entry:
-            outQueue.put(entry, block = True)
-        elif 'dir' in entry:
-            for item in parseIndex(entry['url']):
-                outQueue.put(item, block = True)
-        sys.exit(0)
-
-def indexURL_Threaded(url, whitelist = [], blacklist = [], maxThreads = 8):
-    processes = []
-    indices = {}
-    outQueue = mp.Queue()
-    passes = 0
-
-    # first process
-    processes.append(mp.Process(
-            target = evaluateIndexEntry_ThreadSafe,
-            args = (outQueue, {'dir':'', 'url':url}, whitelist, blacklist)
-        ))
-    processes[0].start()
-
-    # process manager
-    while passes < 4:
-        # handle trials
-        if len(processes) > 0:
-            passes = 0
-        else:
-            passes = passes + 1
-        # generate process from queue entries
-        while True:
-            try:
-                index = outQueue.get(block = False)
-                if 'file' in index:
-                    # filter
-                    if len(whitelist) > 0 and not matchRegex(index['url'], whitelist):
-                        continue
-                    elif len(blacklist) > 0 and matchRegex(index['url'], blacklist):
-                        continue
-                    # skip processing for file
-                    # store in directory-oriented indices
-                    path = index['url']
-                    if url.endswith('/'):
-                        path = path.removeprefix(url)
-                    else:
-                        path = path.removeprefix(url + '/')
-                    path = path.split('/')
-                    vect = indices
-                    while len(path) > 1:
-                        if not path[0] in vect:
-                            vect[path[0]] = {}
-                        vect = vect[path.pop(0)]
-                    if not 'files' in vect:
-                        vect['files'] = []
-                    vect['files'].append(index)
-                else:
-                    processes.append(mp.Process(
-                            target = evaluateIndexEntry_ThreadSafe,
-                            args = (outQueue, index, whitelist, blacklist)
-                        ))
-            except:
-                break
-        # process
-        thread = 0
-        while thread < maxThreads:
-            # handle processable threads less than available threads
+        path = path.removeprefix(url + '/')
+    path = path.split('/')
+    vect = indices
+    while len(path) > 1:
+        if not path[0] in vect:
+            vect[path[0]] = {}
+        vect = vect[path.pop(0)]
+    if not 'files' in vect:
+        vect['files'] = []
+    vect['files'].append(entry)
+
+class CrawlState:
+    '''Bookkeeping shared by the crawling engines: filters, listing cache,
+    timestamp pruning and the resulting directory-oriented indices'''
+    def __init__(self, url, whitelist = [], blacklist = [], listingCache = None, prevIndex = None, prevStamps = None, onFile = None, ready = None):
+        self.url = url
+        self.base = url if url.endswith('/') else url + '/'
+        self.whitelist = whitelist
+        self.blacklist = blacklist
+        self.filter = URLFilter(whitelist, blacklist)
+        self.listingCache = listingCache
+        self.indices = {}
+        # relative directory path -> [timestamp, leaf]
+        self.stamps = {}
+        self.pruned = 0
+        # called with every file entry as soon as it is discovered
+        self.onFile = onFile
+        # pipeline.Gate closed while onFile consumers are behind: the
+        # engines wait for it before requesting more listings
+        self.ready = ready
+        self.prevIndex = None
+        self.prevStamps = {}
+        # stamps pending a leaf decision: relative path -> server time
+        # (UTC epoch) of the listing they were read from
+        self.observed = {}
+        self.lag = MAX_STAMP_LAG
+        # pruning is only sound when the previous crawl used the same filters
+        if prevIndex is not None and prevStamps is not None and prevStamps.get('filters') == [whitelist, blacklist]:
+            self.prevIndex = prevIndex
+            self.prevStamps = prevStamps.get('dirs', {})
+    def validators(self, dirURL):
+        if self.listingCache is None:
+            return {}
+        return self.listingCache.validators(dirURL)
+    def addFile(self, entry):
+        insertIndexEntry(self.indices, self.url, entry)
+        if self.onFile is not None:
+            self.onFile(entry)
+    def relativeDir(self, dirURL):
+        return dirURL.removeprefix(self.base).strip('/')
+    def start(self):
+        if not self.filter.matchDir(self.base):
+            return []
+        return [self.url]
+    def serverTime(self, meta):
+        # Date header of a listing, the local clock without one
+        try:
+            return email.utils.parsedate_to_datetime(meta['date']).timestamp()
+        except Exception:
+            return time.time()
+    def settled(self, stamp, observed):
+        # stamp covers a whole minute and lags UTC by up to self.lag: it
+        # must end before the safety window on the server's clock
+        value = encodeStamp(stamp)
+        return value is not None and value + self.lag + 60 + STAMP_WINDOW <= observed
+    def graft(self, rel, item):
+        # a leaf directory whose timestamp did not change keeps its listing:
+        # reuse the previous subtree instead of requesting it again
+        prev = self.prevStamps.get(rel)
+        if prev is None or not prev[1] or prev[0] != item['timestamp'] or item['timestamp'] == '':
+            return False
+        subtree = transverseDict(self.prevIndex, rel.split('/'))
+        if subtree is None:
+            subtree = {}
+        if len([key for key in subtree.keys() if key != 'files']) > 0:
+            return False
+        for entry in subtree.get('files', []):
+            if self.filter.matchFile(entry['url']):
+                self.addFile(entry)
+        self.stamps[rel] = prev
+        self.pruned += 1
+        return True
+    def handle(self, dirURL, status, items, meta):
+        # returns the directories which still need listing
+        pending = []
+        if 'parse_seconds' in meta:
+            registry.observe('parse_duration_seconds', meta.pop('parse_seconds'))
+        registry.count('listing_requests', result = 'ok' if status == 200 else 'not_modified' if status == 304 else 'failed')
+        if self.listingCache is not None:
+            items = self.listingCache.resolve(dirURL, status, items, meta)
+        rel = self.relativeDir(dirURL)
+        now = self.serverTime(meta)
+        # no stamp is ahead of the server's local time: the newest one
+        # bounds how far behind UTC the stamps are
+        newest = max((item.get('timestamp', '') for item in items), default = '')
+        value = encodeStamp(newest)
+        if value is not None:
+            self.lag = min(self.lag, now - value)
+        observed = self.observed.pop(rel, now)
+        if status not in (200, 304):
+            # never prune a directory which was not listed successfully
+            self.stamps.pop(rel, None)
+        elif rel in self.stamps:
+            self.stamps[rel][1] = self.settled(self.stamps[rel][0], observed) and not any('dir' in item for item in items)
+        for item in items:
+            if 'file' in item:
+                if self.filter.matchFile(item['url']):
+                    self.addFile(item)
+            elif self.filter.matchDir(item['url']):
+                subrel = self.relativeDir(item['url'])
+                if self.prevIndex is not None and self.graft(subrel, item):
+                    continue
+                self.stamps[subrel] = [item['timestamp'], False]
+                self.observed[subrel] = now
+                pending.append(item['url'])
+        return pending
+    def stampsIndex(self):
+        return {
+            'filters' : [self.whitelist, self.blacklist],
+            'dirs' : self.stamps
+        }
+
+def indexURL_Threaded(url, whitelist = [], blacklist = [], maxThreads = 8, listingCache = None):
+    return crawlState_Threaded(CrawlState(url, whitelist, blacklist, listingCache), maxThreads)
+
+def crawlState_Threaded(state, maxThreads = 8):
+    # not forked from the caller, which may run threads holding locks
+    # (downloader, pipeline, aria2 notifications): a fork server started
+    # once with this module loaded forks the workers
+    context = mp.get_context('forkserver')
+    context.set_forkserver_preload(['analyse'])
+    inQueue = context.Queue()
+    outQueue = context.Queue()
+    # directories queued but not yet answered by a worker
+    outstanding = 0
+
+    for dirURL in state.start():
+        inQueue.put((dirURL, state.validators(dirURL)))
+        outstanding += 1
+    workers = [context.Process(
+            target = indexWorker_ThreadSafe,
+            args = (inQueue, outQueue)
+        ) for i in range(max(1, maxThreads))]
+    try:
+        for worker in workers:
+            worker.start()
+
+        # coordinator: blocks on results, crawl is complete when nothing is outstanding
+        while outstanding > 0:
             try:
-                if processes[thread].is_alive():
-                    thread = thread + 1
-                else:
-                    if processes[thread].exitcode is None:
-                        processes[thread].start()
-                        thread = thread + 1
-                    else:
-                        processes.pop(thread)
-            except:
-                break
-    return indices
+                dirURL, status, items, meta = outQueue.get(block = True, timeout = 5)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    print('ERROR: All crawling workers exited unexpectedly.')
+                    break
+                continue
+            outstanding -= 1
+            if state.ready is not None:
+                state.ready.wait()
+            for subURL in state.handle(dirURL, status, items, meta):
+                inQueue.put((subURL, state.validators(subURL)))
+                outstanding += 1
+    finally:
+        # stop workers, also when the crawl is interrupted
+        started = [worker for worker in workers if worker.pid is not None]
+        for worker in started:
+            inQueue.put(None)
+        for worker in started:
+            # a worker still busy with a listing nobody will read is killed
+            worker.join(timeout = 5)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+    return state.indices
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+'''
+Index "pool" from APT metadata (dists/*/Release, Packages and Sources)
+instead of crawling every pool directory listing: pool files the metadata
+does not list are not mirrored
+'''
+
+# python 3.9 and onward required
+
+import io
+import re
+import gzip
+import lzma
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from analyse import CrawlState
+from urlfilter import URLFilter
+from dicttools import filesTree, transverseDict
+
+# preferred compression first
+METADATA_SUFFIXES = ['.xz', '.gz', '']
+METADATA_NAMES = ['Packages', 'Sources']
+
+def aptCrawlState(url, whitelist = [], blacklist = [], listingCache = None, prevIndex = None, prevStamps = None, onFile = None, ready = None):
+    # HTML crawl of everything except "pool"
+    base = url if url.endswith('/') else url + '/'
+    return CrawlState(url, whitelist, blacklist + ['^' + re.escape(base + 'pool/')], listingCache, prevIndex, prevStamps, onFile, ready)
+
+def metadataFiles(index):
+    # best compressed variant of every Packages/Sources file, plus Release files
+    found = {}
+    releases = []
+    for path in filesTree(index):
+        if len(path) < 2 or path[0] != 'dists' or 'by-hash' in path:
+            continue
+        for entry in transverseDict(index, path):
+            dirURL, name = entry['url'].rsplit('/', 1)
+            if name == 'Release' and len(path) == 3:
+                releases.append(entry)
+                continue
+            for metaName in METADATA_NAMES:
+                for rank, suffix in enumerate(METADATA_SUFFIXES):
+                    if name == metaName + suffix:
+                        key = (dirURL, metaName)
+                        if key not in found or found[key][0] > rank:
+                            found[key] = (rank, entry['url'])
+    return [found[key][1] for key in sorted(found.keys())], releases
+
+def openMetadata(url, session):
+    r = session.get(url, stream = True, timeout = 120)
+    r.raise_for_status()
+    r.raw.decode_content = True
+    # keep the stream readable until the text wrapper reaches EOF
+    r.raw.auto_close = False
+    stream = r.raw
+    if url.endswith('.xz'):
+        stream = lzma.open(stream)
+    elif url.endswith('.gz'):
+        stream = gzip.open(stream)
+    return io.TextIOWrapper(stream, encoding = 'utf-8', errors = 'replace')
+
+def iterStanzas(lines):
+    # deb822 paragraphs as dicts; continuation lines are kept in a list
+    stanza = {}
+    field = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if line == '':
+            if len(stanza) > 0:
+                yield stanza
+            stanza = {}
+            field = None
+        elif line[0] in ' \t':
+            if field is not None:
+                stanza[field].append(line.strip())
+        else:
+            field, _, value = line.partition(':')
+            stanza[field] = [value.strip()]
+    if len(stanza) > 0:
+        yield stanza
+
+# yields (path relative to the repository root, size, sha256)
+def iterPackagesFiles(lines):
+    for stanza in iterStanzas(lines):
+        if 'Filename' in stanza and 'Size' in stanza:
+            yield stanza['Filename'][0], int(stanza['Size'][0]), stanza.get('SHA256', [''])[0]
+
+def iterSourcesFiles(lines):
+    for stanza in iterStanzas(lines):
+        if 'Directory' not in stanza or 'Checksums-Sha256' not in stanza:
+            continue
+        directory = stanza['Directory'][0].strip('/')
+        for line in stanza['Checksums-Sha256']:
+            pieces = line.split()
+            if len(pieces) == 3:
+                yield directory + '/' + pieces[2], int(pieces[1]), pieces[0]
+
+# "SHA256:" section of a Release file: path relative to the suite -> (size, sha256)
+def parseRelease(lines):
+    checksums = {}
+    for stanza in iterStanzas(lines):
+        for line in stanza.get('SHA256', []):
+            pieces = line.split()
+            if len(pieces) == 3:
+                checksums[pieces[2]] = (int(pieces[1]), pieces[0])
+        break
+    return checksums
+
+def metadataEntries(url, base, session):
+    entries = []
+    try:
+        with openMetadata(url, session) as lines:
+            if url.rsplit('/', 1)[1].startswith('Sources'):
+                files = iterSourcesFiles(lines)
+            else:
+                files = iterPackagesFiles(lines)
+            for path, size, sha256 in files:
+                entry = {
+                    'file' : '%d' % size,
+                    'timestamp' : '',
+                    'url' : base + path
+                }
+                if sha256 != '':
+                    entry['sha256'] = sha256
+                entries.append(entry)
+    except Exception as e:
+        print('Failed reading APT metadata %s: %s' % (url, str(e)))
+        return None
+    return entries
+
+def annotateRelease(index, release, session):
+    # exact sizes & hashes for the files under dists/<suite>/
+    suiteURL = release['url'].rsplit('/', 1)[0] + '/'
+    try:
+        with openMetadata(release['url'], session) as lines:
+            checksums = parseRelease(lines)
+    except Exception as e:
+        print('Failed reading %s: %s' % (release['url'], str(e)))
+        return
+    for path in filesTree(index):
+        for entry in transverseDict(index, path):
+            if entry['url'].startswith(suiteURL):
+                checksum = checksums.get(entry['url'].removeprefix(suiteURL))
+                if checksum is not None:
+                    entry['file'] = '%d' % checksum[0]
+                    entry['sha256'] = checksum[1]
+
+def poolCrawlState(state, whitelist = [], blacklist = [], listingCache = None, onFile = None, ready = None):
+    '''HTML crawl of "pool" when the APT metadata is unusable; its directory
+    stamps are kept under "pool/" in those of the aptCrawlState'''
+    prevIndex = None
+    prevStamps = None
+    # state only holds a previous index when its stamps apply
+    if state.prevIndex is not None:
+        prevIndex = state.prevIndex.get('pool', {})
+        prevStamps = {
+            'filters' : [whitelist, blacklist],
+            'dirs' : dict((rel.removeprefix('pool/'), stamp) for rel, stamp in state.prevStamps.items() if rel.startswith('pool/'))
+        }
+    return CrawlState(state.base + 'pool', whitelist, blacklist, listingCache, prevIndex, prevStamps, onFile, ready)
+
+def mergePoolStamps(state, poolState):
+    for rel, stamp in poolState.stamps.items():
+        state.stamps['pool/' + rel] = stamp
+    state.pruned += poolState.pruned
+
+def readAPTMetadata(state, whitelist = [], blacklist = [], maxThreads = 8):
+    '''"pool" files listed by the APT metadata of an indexed (aptCrawlState)
+    crawl by URL, None when the metadata is unusable'''
+    sources, releases = metadataFiles(state.indices)
+    if len(sources) == 0:
+        return None
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize = maxThreads)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    fileFilter = URLFilter(whitelist, blacklist)
+    pool = {}
+    failed = False
+    with ThreadPoolExecutor(max_workers = maxThreads) as executor:
+        for entries in executor.map(lambda url: metadataEntries(url, state.base, session), sources):
+            if entries is None:
+                failed = True
+                break
+            for entry in entries:
+                # the same file is listed by every suite & architecture it belongs to
+                if entry['url'] not in pool and fileFilter.matchFile(entry['url']):
+                    pool[entry['url']] = entry
+    # a partial pool would get mirrored files deleted
+    if not failed:
+        for release in releases:
+            annotateRelease(state.indices, release, session)
+    session.close()
+    if failed:
+        return None
+    return pool
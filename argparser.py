@@ -47,14 +47,28 @@ class ConsoleArguments:
     cache = Argument(def_general.cache)
     include = Argument(def_general.whitelist)
     exclude = Argument(def_general.blacklist)
+    crawler = Argument(def_general.crawler)
+    connections = Argument(def_general.connections)
+    indexer = Argument(def_general.indexer)
+    listing_cache = Argument(def_general.listing_cache)
+    incremental = Argument(def_general.incremental)
+    verify = Argument(def_general.verify)
+    index_format = Argument(def_general.index_format)
+    diff_memory = Argument(def_general.diff_memory)
+    pipeline = Argument(def_general.pipeline)
+    downloader = Argument(def_general.downloader)
+    store = Argument(def_general.store)
+    journal = Argument(def_general.journal)
     detach_aria2 = Argument(def_aria2.detach)
     rpc_listen_all = Argument(def_aria2.listen_all)
     rpc_port = Argument(def_aria2.port)
     rpc_secret = Argument(def_aria2.secret)
+    rpc_batch_size = Argument(def_aria2.batch_size)
     save = Argument(not_in_config = True)
     destination_trim = Argument(not_in_config = True)
     trim_dryrun = Argument(not_in_config = True)
     trim_use_scanned = Argument(not_in_config = True)
+    reconcile = Argument(not_in_config = True)
     default_values = True
     def __init__(self):
         self.parser.add_argument('-C', '--config', type=Path, metavar='config_file', help='Path to INI config file.')
@@ -62,16 +76,30 @@ class ConsoleArguments:
         self.parser.add_argument('-d', '--distro', type=str, help='The distro to get from the source and set at the destination.')
         self.parser.add_argument('-p', '--destination', type=Path, metavar='path', help='Where to store the mirrored.')
         self.parser.add_argument('-c', '--cache', type=Path, metavar='path', help='Where to store the latest file lists from source.')
-        self.parser.add_argument('-i', '--include', action='append', type=str, help='Files to include with the mirroring.')
+        self.parser.add_argument('-i', '--include', action='append', type=str, help='Files to include with the mirroring (regex on URL; anchor with ^ and the full URL to let the crawler skip unrelated directories).')
         self.parser.add_argument('-x', '--exclude', action='append', type=str, help='Files to exclude from the mirroring.')
+        self.parser.add_argument('-e', '--crawler', type=str, choices=['process', 'async'], help='Crawling engine: one process per directory or asyncio with keep-alive connections (default: process).')
+        self.parser.add_argument('-n', '--connections', type=int, metavar='N', help='Maximum parallel crawling processes or connections per host.')
+        self.parser.add_argument('-m', '--indexer', type=str, choices=['html', 'apt'], help='Build the "pool" index by crawling its listings (html) or from the APT metadata under "dists" (apt), with exact sizes and SHA256; pool files the metadata does not list are then not mirrored, the listings are only crawled when the metadata is unusable.')
+        self.parser.add_argument('-N', '--no-listing-cache', dest='listing_cache', action='store_false', help='Re-download every directory listing instead of revalidating cached ones (ETag / Last-Modified).')
+        self.parser.add_argument('-I', '--incremental', action='store_true', help='Skip listing leaf directories whose timestamp did not change since the previous index.')
+        self.parser.add_argument('-V', '--verify', type=str, choices=['off', 'full', 'incremental'], help='Check downloaded files against the SHA256 sums of the APT metadata and re-download mismatches; incremental only hashes files changed since the last verified run.')
+        self.parser.add_argument('-F', '--index-format', type=str, choices=['json', 'packed', 'ndjson', 'ndjson.gz', 'ndjson.zst'], help='On-disk format of the cached index: pretty-printed JSON, compact memory-mappable binary (.hsix) or one line per file written while crawling (optionally gzip or zstd compressed, zstd needs the "zstandard" package).')
+        self.parser.add_argument('-M', '--diff-memory', type=int, metavar='MiB', help='Diff indices out of core, spilling sorted runs to the cache directory, within about this much memory (default: 0, in memory; streamed indices are always diffed out of core, in 64 MiB by default).')
+        self.parser.add_argument('-Q', '--pipeline', action='store_true', help='Queue new and changed files in aria2 as soon as the crawler finds them instead of after the diff; deletions still wait for the crawl to finish.')
+        self.parser.add_argument('-w', '--downloader', type=str, choices=['aria2', 'native'], help='Download through an aria2 RPC instance or the built-in asyncio downloader (resumes with Range requests, connections per host from -n; default: aria2).')
+        self.parser.add_argument('-H', '--store', type=str, metavar='path', help='Content-addressed store of hardlinks shared by all mirrored trees (same filesystem): identical files are linked instead of downloaded again.')
+        self.parser.add_argument('-J', '--no-journal', dest='journal', action='store_false', help='Do not record fetched & deleted files in the state journal (SQLite in the cache directory), trims then always rescan the destination.')
         self.parser.add_argument('-A', '--detach-aria2', action='store_true', help='Use an existing aria2 RPC server instance instead of spawning new one (the instance must run on localhost and must have same port and secret specified in config file).')
         self.parser.add_argument('-L', '--rpc-listen-all', action='store_true', help='Allow aria2 RPC server to listen on all interfaces (default: localhost).')
         self.parser.add_argument('-P', '--rpc-port', type=int, help='Port of aria2 RPC server.')
         self.parser.add_argument('-S', '--rpc-secret', type=str, help='aria2 RPC protocol secret (security).')
+        self.parser.add_argument('-B', '--rpc-batch-size', type=int, metavar='N', help='Downloads queued per aria2 RPC request (system.multicall, default: 1000).')
         self.parser.add_argument('-s', '--save', action='store_true', help='Save configured to file (specified via -C).')
         self.parser.add_argument('-t', '--destination-trim', action='store_true', help='Triming destination from excess files.')
         self.parser.add_argument('-D', '--trim-dryrun', action='store_true', help='Only scan destination for excess files.')
         self.parser.add_argument('-r', '--trim-use-scanned', action='store_true', help='Use the previous scan to get excess files.')
+        self.parser.add_argument('-R', '--reconcile', action='store_true', help='Rescan the destination when trimming and repair the state journal from it.')
     def __setattr__(self, name, value):
         if hasattr(self, name):
             super().__setattr__(name, value)
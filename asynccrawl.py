@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+'''
+asyncio crawling engine: keeps persistent HTTP/1.1 connections per host
+instead of spawning one process (and one connection) per directory
+'''
+
+# python 3.9 and onward required
+
+import time
+import asyncio
+import threading
+import aiohttp
+from analyse import parseIndexContent, CrawlState
+from metrics import registry
+
+def createSession(maxConnections = 8):
+    # keep-alive pool bounded per host; listings are requested compressed
+    connector = aiohttp.TCPConnector(limit = 0, limit_per_host = maxConnections, keepalive_timeout = 30)
+    return aiohttp.ClientSession(
+            connector = connector,
+            headers = { 'Accept-Encoding' : 'gzip, deflate' },
+            timeout = aiohttp.ClientTimeout(total = 120)
+        )
+
+# conditional GET: returns (status, entries, validators); status 0 on failure
+async def fetchIndex_Async(session, url, validators = {}, retries = 3):
+    for attempt in range(retries):
+        try:
+            async with session.get(url, headers = validators) as r:
+                if r.status == 304:
+                    return 304, None, { 'date' : r.headers.get('Date') }
+                r.raise_for_status()
+                text = await r.text(errors = 'replace')
+                meta = {
+                    'etag' : r.headers.get('ETag'),
+                    'last_modified' : r.headers.get('Last-Modified'),
+                    'date' : r.headers.get('Date')
+                }
+                start = time.perf_counter()
+                entries = parseIndexContent(url, r.headers.get('Content-Type', ''), r.headers.get('Server', ''), text)
+                meta['parse_seconds'] = time.perf_counter() - start
+                return r.status, entries, meta
+        except Exception as e:
+            if attempt + 1 >= retries:
+                print('Failed listing %s: %s' % (url, str(e)))
+            else:
+                registry.count('listing_retries')
+                await asyncio.sleep(attempt + 1)
+    return 0, [], {}
+
+async def crawlState_AsyncTasks(session, state, maxTasks = 8):
+    queue = asyncio.Queue()
+
+    async def worker():
+        while True:
+            dirURL = await queue.get()
+            try:
+                if state.ready is not None and not state.ready.is_set():
+                    # paused without blocking the loop shared with other crawls
+                    await state.ready.waitAsync()
+                try:
+                    status, items, meta = await fetchIndex_Async(session, dirURL, state.validators(dirURL))
+                    pending = state.handle(dirURL, status, items, meta)
+                except Exception as e:
+                    # a failed listing, as in crawlState_Threaded; the worker goes on
+                    print('Failed listing %s: %s' % (dirURL, str(e)))
+                    pending = state.handle(dirURL, 0, [], {})
+                for subURL in pending:
+                    queue.put_nowait(subURL)
+            except Exception as e:
+                print('Failed handling listing %s: %s' % (dirURL, str(e)))
+            finally:
+                queue.task_done()
+
+    for dirURL in state.start():
+        queue.put_nowait(dirURL)
+    workers = [asyncio.create_task(worker()) for i in range(maxTasks)]
+    await queue.join()
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions = True)
+    return state.indices
+
+async def crawlState_AsyncMain(state, maxConnections):
+    async with createSession(maxConnections) as session:
+        return await crawlState_AsyncTasks(session, state, maxConnections)
+
+def crawlState_Async(state, maxConnections = 8):
+    return asyncio.run(crawlState_AsyncMain(state, maxConnections))
+
+class SharedCrawler:
+    '''Crawls the states handed over by any thread in one event loop,
+    through one connection pool shared by all of them'''
+    def __init__(self, maxConnections = 8):
+        self.maxConnections = maxConnections
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.session = None
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+    async def openSession(self):
+        return createSession(self.maxConnections)
+    def start(self):
+        self.thread = threading.Thread(target = self.loop.run_forever, daemon = True)
+        self.thread.start()
+        self.session = self.run(self.openSession())
+        return self
+    def crawl(self, state):
+        return self.run(crawlState_AsyncTasks(self.session, state, self.maxConnections))
+    def stop(self):
+        if self.thread is not None:
+            self.run(self.session.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+            self.loop.close()
+
+def indexURL_Async(url, whitelist = [], blacklist = [], maxConnections = 8, listingCache = None):
+    return crawlState_Async(CrawlState(url, whitelist, blacklist, listingCache), maxConnections)
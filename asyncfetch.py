@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+'''
+Native asyncio download backend: pooled keep-alive connections bounded per
+host, resumes partial files with Range requests (If-Range on the validator of
+the first response), writes to a ".part" file renamed into place once
+complete, retries failed downloads
+'''
+
+# python 3.9 and onward required
+
+import os
+import json
+import asyncio
+import threading
+import aiohttp
+from pathlib import Path
+from urllib.parse import unquote
+from downloader import Downloader
+from metrics import registry
+
+PART_SUFFIX = '.part'
+VALIDATOR_SUFFIX = '.part.validator'
+CHUNK_SIZE = 1 << 16
+
+def createSession(maxConnections = 8):
+    # files are stored as served: no transparent decompression
+    connector = aiohttp.TCPConnector(limit = 0, limit_per_host = maxConnections, keepalive_timeout = 30)
+    return aiohttp.ClientSession(
+            connector = connector,
+            auto_decompress = False,
+            headers = { 'Accept-Encoding' : 'identity' },
+            timeout = aiohttp.ClientTimeout(total = None, sock_connect = 30, sock_read = 120)
+        )
+
+def readValidator(path):
+    try:
+        with path.open('r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def contentRange(value):
+    # (start, total) of "bytes start-end/total", None when malformed
+    try:
+        unit, spec = value.split(' ', 1)
+        span, total = spec.split('/', 1)
+        start = int(span.split('-', 1)[0])
+        return start, None if total == '*' else int(total)
+    except (AttributeError, ValueError):
+        return None
+
+async def fetchFile_Async(session, url, path):
+    part = path.with_name(path.name + PART_SUFFIX)
+    # ETag / Last-Modified of the response the partial file comes from
+    validatorPath = path.with_name(path.name + VALIDATOR_SUFFIX)
+    offset = part.stat().st_size if part.is_file() else 0
+    headers = {}
+    if offset > 0:
+        validator = readValidator(validatorPath)
+        etag = None if validator is None else validator.get('etag')
+        modified = None if validator is None else validator.get('last_modified')
+        if etag is not None and not etag.startswith('W/'):
+            headers['If-Range'] = etag
+        elif modified is not None:
+            headers['If-Range'] = modified
+        # without a validator the server cannot tell whether the bytes match
+        if 'If-Range' in headers:
+            headers['Range'] = 'bytes=%d-' % offset
+        else:
+            offset = 0
+    async with session.get(url, headers = headers) as r:
+        if r.status == 416:
+            # stale partial file (changed or already complete upstream)
+            part.unlink()
+            raise aiohttp.ClientError('Range not satisfiable, restarting')
+        r.raise_for_status()
+        total = None
+        if r.status == 206:
+            span = contentRange(r.headers.get('Content-Range'))
+            if span is None or span[0] != offset:
+                part.unlink()
+                raise aiohttp.ClientPayloadError('Unexpected Content-Range, restarting')
+            total = span[1]
+            mode = 'ab'
+        else:
+            # 200: the whole file (changed upstream, or no Range support)
+            if r.content_length is not None:
+                total = r.content_length
+            mode = 'wb'
+            with validatorPath.open('w') as f:
+                json.dump({ 'etag' : r.headers.get('ETag'), 'last_modified' : r.headers.get('Last-Modified') }, f)
+        with part.open(mode) as f:
+            async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                f.write(chunk)
+    size = part.stat().st_size
+    if total is not None and size != total:
+        if size > total:
+            part.unlink()
+        raise aiohttp.ClientPayloadError('Incomplete download (%d of %d bytes)' % (size, total))
+    os.replace(str(part), str(path))
+    if validatorPath.exists():
+        validatorPath.unlink()
+
+async def downloadFile_Async(session, url, path, retries = 3):
+    for attempt in range(retries):
+        try:
+            path.parent.mkdir(parents = True, exist_ok = True)
+            await fetchFile_Async(session, url, path)
+            return True
+        except Exception as e:
+            if attempt + 1 >= retries:
+                print('Giving up: %s (%s)' % (url, str(e)))
+                registry.count('download_requests', result = 'failed')
+            else:
+                print('Will retry: %s' % url)
+                registry.count('download_requests', result = 'retried')
+                await asyncio.sleep(2 ** attempt)
+    return False
+
+class AsyncDownloader(Downloader):
+    '''Runs an asyncio loop with maxConnections workers on its own thread;
+    add() and wait() are called from any other thread'''
+    def __init__(self, maxConnections = 8, retries = 3):
+        self.maxConnections = maxConnections
+        self.retries = retries
+        self.loop = None
+        self.queue = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.done = threading.Condition()
+        self.outstanding = 0
+        self.completed = 0
+        self.failed = 0
+    def start(self):
+        self.thread = threading.Thread(target = lambda: asyncio.run(self.main()), daemon = True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        async with createSession(self.maxConnections) as session:
+            workers = [asyncio.create_task(self.worker(session)) for i in range(self.maxConnections)]
+            self.ready.set()
+            await asyncio.gather(*workers)
+    async def worker(self, session):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            url, path = item
+            ok = await downloadFile_Async(session, url, path, self.retries)
+            with self.done:
+                self.outstanding -= 1
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self.done.notify_all()
+    def add(self, url, directory):
+        registry.count('download_requests', result = 'queued')
+        with self.done:
+            self.outstanding += 1
+        # named like aria2 does: last path segment, percent-decoded
+        path = Path(directory) / unquote(url.rsplit('/', 1)[1])
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (url, path))
+    def wait(self):
+        with registry.timer('download_wait_seconds', downloader = 'native'), self.done:
+            self.done.wait_for(lambda: self.outstanding == 0)
+    def stop(self):
+        if self.thread is not None:
+            for i in range(self.maxConnections):
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+'''
+Streaming parsers for Apache (table) and NGINX (pre) auto-index pages,
+working on precompiled regexes instead of a DOM
+'''
+
+# python 3.9 and onward required
+
+import re
+from html import unescape
+
+APACHE_ROW = re.compile(r'<tr[^>]*>(.*?)</tr>', re.S | re.I)
+APACHE_CELL = re.compile(r'<td[^>]*>(.*?)</td>', re.S | re.I)
+ATTR_ALT = re.compile(r'<img\b[^>]*?\balt="([^"]*)"', re.I)
+ATTR_HREF = re.compile(r'<a\b[^>]*?\bhref="([^"]*)"', re.I)
+NGINX_PRE = re.compile(r'<pre[^>]*>(.*?)</pre>', re.S | re.I)
+NGINX_LINE = re.compile(r'<a\b[^>]*?\bhref="([^"]*)"[^>]*>.*?</a>([^<]*)', re.S | re.I)
+NGINX_DATE = re.compile(r'^(\d{1,2})-([A-Za-z]{3})-(\d{4})$')
+NGINX_TIME = re.compile(r'^(\d{1,2}):(\d{2})$')
+MONTHS = {
+    'jan' : '01', 'feb' : '02', 'mar' : '03', 'apr' : '04', 'may' : '05', 'jun' : '06',
+    'jul' : '07', 'aug' : '08', 'sep' : '09', 'oct' : '10', 'nov' : '11', 'dec' : '12'
+}
+
+# leading text of a cell (the first node, as parseApacheIndex reads it)
+def cellText(cell):
+    pos = cell.find('<')
+    if pos >= 0:
+        cell = cell[:pos]
+    return unescape(cell).strip()
+
+def streamApacheIndex(text):
+    for row in APACHE_ROW.finditer(text):
+        cells = APACHE_CELL.findall(row.group(1))
+        if len(cells) < 5:
+            continue
+        alt = ATTR_ALT.search(cells[0])
+        href = ATTR_HREF.search(cells[1])
+        yield {
+            'alt' : unescape(alt.group(1)) if alt is not None else '',
+            'href' : unescape(href.group(1)) if href is not None else '',
+            'timestamp' : cellText(cells[2]),
+            'size' : cellText(cells[3]),
+            'desc' : cellText(cells[4])
+        }
+
+def streamNGINXIndex(text):
+    for pre in NGINX_PRE.finditer(text):
+        for line in NGINX_LINE.finditer(pre.group(1)):
+            entry = {
+                'alt' : '',
+                'href' : unescape(line.group(1)),
+                'timestamp' : '',
+                'size' : ''
+            }
+            # trailing content: "dd-Mon-yyyy HH:MM size"
+            for piece in line.group(2).split():
+                date = NGINX_DATE.match(piece)
+                if date is not None and date.group(2).lower() in MONTHS:
+                    entry['timestamp'] = '%s-%s-%02d' % (date.group(3), MONTHS[date.group(2).lower()], int(date.group(1)))
+                else:
+                    time = NGINX_TIME.match(piece)
+                    if time is not None:
+                        entry['timestamp'] = entry['timestamp'] + ' %02d:%s' % (int(time.group(1)), time.group(2))
+                entry['size'] = piece
+            # guess alt using href same origin relative path
+            if entry['href'].find('/') == 0 or entry['href'] == '../':
+                entry['alt'] = '[PARENTDIR]'
+            elif entry['href'].endswith('/'):
+                entry['alt'] = '[DIR]'
+            yield entry
@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+'''
+Micro-benchmarks for httpsync internals, and an end-to-end run ("mirror")
+against a generated APT-like tree served locally
+
+Usage: python3 benchmark.py <benchmark> [options]
+'''
+
+# python 3.9 and onward required
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import contextlib
+import http.server
+import multiprocessing as mp
+import shutil
+import tempfile
+import random
+import argparse
+import datetime
+import tracemalloc
+from urllib.parse import unquote, urlsplit
+from analyse import parseIndexContent, parseIndexContent_Soup, insertIndexEntry, CrawlState, crawlState_Threaded
+from difftree import diffIndices_Threaded, diffIndices_MergeJoin
+from dicttools import listStat, filesTree, transverseDict
+from pathtools import directoryIndex, directoryIndex_Walk, indexFiles
+from treeclean import treeCleanup
+from packedindex import iterIndex
+from fileindex import Index
+
+def timeIt(func, *args, repeat = 3):
+    best = None
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def report(name, seconds, count, unit):
+    print('%-28s %10.3f ms %14.0f %s/s' % (name, seconds * 1000, count / seconds if seconds > 0 else 0, unit))
+
+# listing rows: (name, is_dir, mtime, size)
+def generateListing(rows, dirs = 0, seed = 0):
+    rnd = random.Random(seed)
+    base = datetime.datetime(2020, 1, 1)
+    listing = []
+    for i in range(rows):
+        isDir = i < dirs
+        name = ('pkg%06d' % i) if isDir else ('pkg%06d_1.%d-%d_armhf.deb' % (i, rnd.randrange(100), rnd.randrange(10)))
+        mtime = base + datetime.timedelta(minutes = rnd.randrange(1000000))
+        listing.append((name, isDir, mtime, rnd.randrange(1, 50000000)))
+    return listing
+
+def humanSize(size):
+    for unit in ['', 'K', 'M', 'G']:
+        if size < 1024:
+            return ('%d%s' % (size, unit)) if unit == '' or size >= 10 else ('%.1f%s' % (size, unit))
+        size /= 1024
+    return '%.1fT' % size
+
+def apachePage(path, listing):
+    rows = [
+        '<tr><th valign="top"><img src="/icons/blank.gif" alt="[ICO]"></th><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th><th><a href="?C=S;O=A">Size</a></th><th><a href="?C=D;O=A">Description</a></th></tr>',
+        '<tr><th colspan="5"><hr></th></tr>',
+        '<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td><td><a href="/">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td><td>&nbsp;</td></tr>'
+    ]
+    for name, isDir, mtime, size in listing:
+        rows.append('<tr><td valign="top"><img src="/icons/%s.gif" alt="%s"></td><td><a href="%s">%s</a></td><td align="right">%s  </td><td align="right">%s</td><td>&nbsp;</td></tr>' % (
+                'folder' if isDir else 'unknown',
+                '[DIR]' if isDir else '[   ]',
+                name + ('/' if isDir else ''),
+                name + ('/' if isDir else ''),
+                mtime.strftime('%Y-%m-%d %H:%M'),
+                '  - ' if isDir else humanSize(size)
+            ))
+    rows.append('<tr><th colspan="5"><hr></th></tr>')
+    return '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n<html>\n <head>\n  <title>Index of %s</title>\n </head>\n <body>\n<h1>Index of %s</h1>\n  <table>\n   %s\n</table>\n</body></html>\n' % (path, path, '\n'.join(rows))
+
+def nginxPage(path, listing):
+    lines = ['<a href="../">../</a>']
+    for name, isDir, mtime, size in listing:
+        label = name + ('/' if isDir else '')
+        lines.append('<a href="%s">%s</a>%s %s %19s' % (
+                label,
+                label,
+                ' ' * max(1, 51 - len(label)),
+                mtime.strftime('%d-%b-%Y %H:%M'),
+                '-' if isDir else str(size)
+            ))
+    return '<html>\r\n<head><title>Index of %s</title></head>\r\n<body>\r\n<h1>Index of %s</h1><hr><pre>%s\r\n</pre><hr></body>\r\n</html>\r\n' % (path, path, '\r\n'.join(lines))
+
+# nested index of "files" entries spread over "dirs" pool directories
+def generateIndex(files, dirs, base = 'http://mirror.example/debian/', seed = 0):
+    rnd = random.Random(seed)
+    index = {}
+    for i in range(files):
+        d = rnd.randrange(dirs)
+        path = 'pool/main/%s/pkg%05d/pkg%05d_%d.%d_armhf.deb' % (chr(97 + d % 26), d, d, i, rnd.randrange(10))
+        entry = {
+            'file' : '%d' % rnd.randrange(1, 50000000),
+            'timestamp' : '2021-%02d-%02d %02d:%02d' % (rnd.randrange(1, 13), rnd.randrange(1, 29), rnd.randrange(24), rnd.randrange(60)),
+            'url' : base + path
+        }
+        insertIndexEntry(index, base, entry)
+    return index
+
+# copy of an index with a fraction of its files added, deleted and updated
+def mutateIndex(index, fraction, base = 'http://mirror.example/debian/', seed = 1):
+    rnd = random.Random(seed)
+    mutated = {}
+    added = 0
+    for path in filesTree(index):
+        for entry in transverseDict(index, path):
+            roll = rnd.random()
+            if roll < fraction:
+                continue
+            if roll < 2 * fraction:
+                entry = dict(entry)
+                entry['timestamp'] = '2022-01-01 00:00'
+            elif roll < 3 * fraction:
+                added += 1
+                insertIndexEntry(mutated, base, {
+                    'file' : '1024',
+                    'timestamp' : '2022-01-01 00:00',
+                    'url' : entry['url'].rsplit('/', 1)[0] + '/added%d.deb' % added
+                })
+            insertIndexEntry(mutated, base, entry)
+    return mutated
+
+def legacyDiff(currIndex, newIndex):
+    # the five diffIndices_Threaded calls main used to do
+    newFiles = diffIndices_Threaded(currIndex, newIndex, maxThreads = 64)
+    oldFiles = diffIndices_Threaded(newIndex, currIndex, maxThreads = 64)
+    addedFiles   = diffIndices_Threaded(oldFiles, newFiles, True, 64)
+    deletedFiles = diffIndices_Threaded(newFiles, oldFiles, True, 64)
+    updatedFiles = diffIndices_Threaded(addedFiles, newFiles, True, 64)
+    return listStat(addedFiles), listStat(deletedFiles), listStat(updatedFiles)
+
+def mergeJoinDiff(currIndex, newIndex):
+    diff = diffIndices_MergeJoin(currIndex, newIndex)
+    return listStat(diff['added']), listStat(diff['deleted']), listStat(diff['updated'])
+
+def referenceDiff(currIndex, newIndex):
+    # plain dict/set comparison keyed by URL
+    curr = { entry['url'] : entry for path in filesTree(currIndex) for entry in transverseDict(currIndex, path) }
+    new = { entry['url'] : entry for path in filesTree(newIndex) for entry in transverseDict(newIndex, path) }
+    updated = sum(1 for url in curr.keys() & new.keys() if curr[url] != new[url])
+    return len(new.keys() - curr.keys()), len(curr.keys() - new.keys()), updated
+
+def benchDiff(args):
+    print('Generating indices: %d files in %d directories' % (args.files, args.dirs))
+    currIndex = generateIndex(args.files, args.dirs)
+    newIndex = mutateIndex(currIndex, args.changes)
+    expected = referenceDiff(currIndex, newIndex)
+    mergeTime, mergeCounts = timeIt(mergeJoinDiff, currIndex, newIndex, repeat = args.repeat)
+    print(' - expected: added %d, deleted %d, updated %d' % expected)
+    report(' - merge-join', mergeTime, args.files, 'files')
+    print('   added %d, deleted %d, updated %d' % mergeCounts)
+    if args.legacy:
+        legacyTime, legacyCounts = timeIt(legacyDiff, currIndex, newIndex, repeat = 1)
+        report(' - diffIndices_Threaded x5', legacyTime, args.files, 'files')
+        print('   added %d, deleted %d, updated %d' % legacyCounts)
+        print(' - speed-up: %.1fx' % (legacyTime / mergeTime))
+    return 0 if mergeCounts == expected else 1
+
+# pool-like tree: pool/main/<letter>/<package>/<files>, sparse files of random sizes
+def generateTree(root, files, dirs, seed = 0):
+    rnd = random.Random(seed)
+    paths = []
+    for i in range(dirs):
+        path = os.path.join(root, 'pool', 'main', 'abcdefghijklmnopqrstuvwxyz'[i % 26], 'pkg%05d' % i)
+        os.makedirs(path, exist_ok = True)
+        paths.append(path)
+    for i in range(files):
+        with open(os.path.join(paths[i % dirs], 'pkg%06d_1.%d_armhf.deb' % (i, rnd.randrange(100))), 'wb') as f:
+            f.truncate(rnd.randrange(1 << 20))
+
+def benchScan(args):
+    root = args.path
+    if root is None:
+        root = tempfile.mkdtemp(prefix = 'httpsync-scan-')
+        print('Generating %d files in %d directories under %s' % (args.files, args.dirs, root))
+        generateTree(root, args.files, args.dirs)
+    url = 'http://mirror.example/debian/'
+    try:
+        walkTime, walked = timeIt(directoryIndex_Walk, root, url, repeat = args.repeat)
+        expected = list(iterIndex(walked))
+        print('Scanning %d files (warm cache: best of %d runs)' % (len(expected), args.repeat))
+        report(' - os.walk + stat', walkTime, len(expected), 'files')
+        identical = True
+        for threads in args.threads:
+            scanTime, scanned = timeIt(directoryIndex, root, url, threads, repeat = args.repeat)
+            report(' - scandir, %d threads' % threads, scanTime, len(expected), 'files')
+            print('   speed-up: %.1fx' % (walkTime / scanTime))
+            identical = identical and list(iterIndex(scanned)) == expected
+        print(' - identical output: %s' % identical)
+    finally:
+        if args.path is None and not args.keep:
+            shutil.rmtree(root, ignore_errors = True)
+    return 0 if identical else 1
+
+def allocated(func, *args):
+    # bytes still held by the result of func
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func(*args)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+def legacyListStat(index):
+    return sum(len(transverseDict(index, path)) for path in filesTree(index))
+
+def dictLookup(index, paths):
+    found = 0
+    for relpath in paths:
+        keys = relpath.split('/')
+        files = transverseDict(index, keys[:-1] + ['files'])
+        if files is not None and any(entry['url'].endswith('/' + keys[-1]) for entry in files):
+            found += 1
+    return found
+
+def indexLookup(index, paths):
+    return sum(1 for relpath in paths if index.record(relpath) is not None)
+
+def linearSearch(index, names):
+    # what fetch.searchURL used to do for every name
+    found = 0
+    for name in names:
+        for path in filesTree(index):
+            if any(entry['url'].find(name) > 0 for entry in transverseDict(index, path)):
+                found += 1
+                break
+    return found
+
+def nameSearch(index, names):
+    index.names = None
+    lookup = index.lookup()
+    return sum(1 for name in names if len(lookup.search(name)) > 0)
+
+def benchIndex(args):
+    print('Generating index: %d files in %d directories' % (args.files, args.dirs))
+    dictSize, tree = allocated(generateIndex, args.files, args.dirs)
+    indexSize, index = allocated(Index.fromDict, tree)
+    print(' - nested dicts: %s' % humanSize(dictSize))
+    print(' - Index:        %s (%.1fx smaller)' % (humanSize(indexSize), dictSize / indexSize))
+    statTime, count = timeIt(legacyListStat, tree, repeat = args.repeat)
+    report(' - count, filesTree', statTime, count, 'files')
+    statTime, count = timeIt(listStat, tree, repeat = args.repeat)
+    report(' - count, listStat', statTime, count, 'files')
+    statTime, count = timeIt(len, index, repeat = args.repeat)
+    report(' - count, Index', statTime, count, 'files')
+    paths = [relpath for relpath, entry in random.Random(2).sample(list(iterIndex(tree)), args.lookups)]
+    lookupTime, found = timeIt(dictLookup, tree, paths, repeat = args.repeat)
+    report(' - lookup, nested dicts', lookupTime, found, 'lookups')
+    lookupTime, found = timeIt(indexLookup, index, paths, repeat = args.repeat)
+    report(' - lookup, Index', lookupTime, found, 'lookups')
+    names = [relpath.rsplit('/', 1)[1] for relpath in paths[:args.names]]
+    searchTime, searched = timeIt(linearSearch, tree, names, repeat = 1)
+    report(' - name search, linear', searchTime, searched, 'names')
+    searchTime, searched = timeIt(nameSearch, index, names, repeat = args.repeat)
+    report(' - name search, FileLookup', searchTime, searched, 'names')
+    found = found if searched == len(names) else -1
+    expected = list(iterIndex(tree))
+    identical = list(index.items()) == expected and list(iterIndex(index.toDict())) == expected
+    print(' - identical output: %s' % identical)
+    return 0 if identical and found == args.lookups else 1
+
+SIZE_DISTRIBUTIONS = ['lognormal', 'uniform', 'fixed']
+SERVER_PRODUCTS = { 'apache' : 'Apache/2.4.57 (Debian)', 'nginx' : 'nginx/1.24.0' }
+
+def fileSize(rnd, distribution, mean):
+    if distribution == 'lognormal':
+        # sigma 1: a few large packages, many small ones, same mean
+        return int(rnd.lognormvariate(math.log(mean) - 0.5, 1.0))
+    if distribution == 'uniform':
+        return rnd.randrange(2 * mean)
+    return mean
+
+# APT-like tree: (relative path, size, mtime) of dists/<dist>/... and
+# pool/<component>/<prefix>/<package>/<package>_<version>_<arch>.deb
+def generateMirror(packages, dists, distribution = 'lognormal', meanSize = 1 << 18, seed = 0):
+    rnd = random.Random(seed)
+    base = datetime.datetime(2021, 1, 1)
+    def mtime():
+        return base + datetime.timedelta(minutes = rnd.randrange(1000000))
+    files = []
+    for d in range(dists):
+        dist = 'dist%02d' % d
+        for name in ['Release', 'Release.gpg', 'InRelease']:
+            files.append(('dists/%s/%s' % (dist, name), rnd.randrange(1000, 100000), mtime()))
+        for component in ['main', 'contrib', 'non-free']:
+            for arch, metadata in [('binary-armhf', 'Packages'), ('source', 'Sources')]:
+                size = packages * rnd.randrange(500, 1500)
+                for suffix, ratio in [('', 1), ('.gz', 4), ('.xz', 6)]:
+                    files.append(('dists/%s/%s/%s/%s%s' % (dist, component, arch, metadata, suffix), size // ratio, mtime()))
+    for i in range(packages):
+        roll = rnd.random()
+        component = 'main' if roll < 0.9 else 'contrib' if roll < 0.95 else 'non-free'
+        letter = 'abcdefghijklmnopqrstuvwxyz'[rnd.randrange(26)]
+        if rnd.random() < 0.2:
+            name = 'lib%s%05d' % (letter, i)
+            prefix = name[:4]
+        else:
+            name = '%spkg%05d' % (letter, i)
+            prefix = letter
+        for version in range(rnd.randrange(1, 4)):
+            files.append(('pool/%s/%s/%s/%s_%d.%d-%d_armhf.deb' % (component, prefix, name, name, version + 1, rnd.randrange(10), rnd.randrange(5)),
+                    fileSize(rnd, distribution, meanSize), mtime()))
+    return files
+
+# the same tree with a fraction of its files deleted, updated and added (each)
+def mutateMirror(files, fraction, seed = 1):
+    rnd = random.Random(seed)
+    mutated = []
+    for path, size, mtime in files:
+        roll = rnd.random()
+        if roll < fraction:
+            continue
+        if roll < 2 * fraction:
+            mutated.append((path, size + 1, mtime + datetime.timedelta(days = 1)))
+            continue
+        if roll < 3 * fraction:
+            mutated.append((path.rsplit('.', 1)[0] + '+b1.deb', size, mtime + datetime.timedelta(days = 1)))
+        mutated.append((path, size, mtime))
+    return mutated
+
+# listing rows of every directory, '' being the root
+def mirrorListings(files):
+    listings = { '' : {} }
+    for path, size, mtime in files:
+        parts = path.split('/')
+        for i in range(len(parts)):
+            directory = '/'.join(parts[:i])
+            rows = listings.setdefault(directory, {})
+            if i == len(parts) - 1:
+                rows[parts[i]] = (parts[i], False, mtime, size)
+            else:
+                previous = rows.get(parts[i])
+                rows[parts[i]] = (parts[i], True, mtime if previous is None else max(previous[2], mtime), 0)
+    return { directory : [rows[name] for name in sorted(rows.keys())] for directory, rows in listings.items() }
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers & body are written apart: no delayed ACK stall in between
+    disable_nagle_algorithm = True
+    def version_string(self):
+        return SERVER_PRODUCTS[self.server.style]
+    def log_message(self, *args):
+        pass
+    def do_GET(self):
+        path = unquote(urlsplit(self.path).path)
+        rel = path.removeprefix(self.server.prefix)
+        if rel == path:
+            body = None
+        elif rel == '' or rel.endswith('/'):
+            body = self.server.pages.get(rel.rstrip('/'))
+        else:
+            body = self.server.sizes.get(rel)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        if type(body) is bytes:
+            self.send_header('Content-Type', 'text/html;charset=UTF-8')
+            self.send_header('Content-Length', '%d' % len(body))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        # package contents: zeroes
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', '%d' % body)
+        self.end_headers()
+        chunk = bytes(1 << 16)
+        while body > 0:
+            self.wfile.write(chunk[:body])
+            body -= len(chunk)
+
+def serveMirror(files, style, prefix, port, conn):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MirrorHandler)
+    server.daemon_threads = True
+    server.style = style
+    server.prefix = prefix
+    page = nginxPage if style == 'nginx' else apachePage
+    server.pages = { directory : page(prefix + directory + ('/' if directory != '' else ''), listing).encode('utf-8')
+            for directory, listing in mirrorListings(files).items() }
+    server.sizes = { path : size for path, size, mtime in files }
+    conn.send(server.server_address[1])
+    server.serve_forever()
+
+class MirrorServer:
+    '''Serves a generated tree (autoindex pages of the given style with its
+    Server header, zero-filled files) from a separate process'''
+    def __init__(self, files, style = 'apache', prefix = '/debian/', port = 0):
+        self.files = files
+        self.style = style
+        self.prefix = prefix
+        self.port = port
+        self.process = None
+        self.url = None
+    def __enter__(self):
+        parent, child = mp.Pipe()
+        self.process = mp.Process(target = serveMirror, args = (self.files, self.style, self.prefix, self.port, child), daemon = True)
+        self.process.start()
+        self.port = parent.recv()
+        self.url = 'http://127.0.0.1:%d%s' % (self.port, self.prefix)
+        return self
+    def __exit__(self, *args):
+        self.process.terminate()
+        self.process.join()
+
+def crawlMirror(url, engine, connections):
+    state = CrawlState(url)
+    if engine == 'async':
+        from asynccrawl import crawlState_Async
+        return crawlState_Async(state, connections)
+    return crawlState_Threaded(state, connections)
+
+def quietly(func, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args)
+
+def materialize(index, parent):
+    # sparse files where the index says
+    for entry, path in indexFiles(index, parent):
+        path.parent.mkdir(parents = True, exist_ok = True)
+        with path.open('wb') as f:
+            f.truncate(int(entry['file']) if entry['file'].isdigit() else 0)
+
+def benchMirror(args):
+    files = generateMirror(args.packages, args.dists, args.sizes, args.mean_size)
+    changed = mutateMirror(files, args.changes)
+    directories = len(mirrorListings(files))
+    print('Generated mirror: %d files in %d directories, %s sizes (%s in total)' % (len(files), directories, args.sizes, humanSize(sum(size for path, size, mtime in files))))
+    results = {}
+    def record(name, seconds, count, unit):
+        report(name, seconds, count, unit)
+        results[name.strip(' -')] = { 'seconds' : seconds, 'count' : count, 'unit' : unit, 'rate' : count / seconds if seconds > 0 else 0 }
+    ok = True
+    currIndex = None
+    port = None
+    for style in args.servers:
+        for engine in args.engines:
+            with MirrorServer(files, style) as server:
+                crawlTime, crawled = timeIt(crawlMirror, server.url, engine, args.connections, repeat = args.repeat)
+            record(' - crawl, %s, %s' % (style, engine), crawlTime, directories, 'listings')
+            ok = ok and listStat(crawled) == len(files)
+            if currIndex is None:
+                currIndex = crawled
+                port = server.port
+    # Apache rounds sizes, nginx does not: both crawls from the same server (& URL)
+    with MirrorServer(changed, args.servers[0], port = port) as server:
+        newIndex = crawlMirror(server.url, args.engines[0], args.connections)
+    ok = ok and listStat(newIndex) == len(changed)
+    diffTime, diff = timeIt(diffIndices_MergeJoin, currIndex, newIndex, repeat = args.repeat)
+    record(' - diff', diffTime, len(files), 'files')
+    print('   added %d, deleted %d, updated %d' % (listStat(diff['added']), listStat(diff['deleted']), listStat(diff['updated'])))
+    root = tempfile.mkdtemp(prefix = 'httpsync-mirror-')
+    try:
+        parent = os.path.join(root, 'debian')
+        materialize(currIndex, parent)
+        url = 'http://mirror.example/debian/'
+        scanTime, scanned = timeIt(directoryIndex, parent, url, repeat = args.repeat)
+        record(' - destination scan', scanTime, len(files), 'files')
+        ok = ok and listStat(scanned) == len(files)
+        def trim():
+            return diffIndices_MergeJoin(newIndex, directoryIndex(parent, url), pathOnly = True)['added']
+        trimTime, excess = timeIt(trim, repeat = args.repeat)
+        record(' - trim (scan + compare)', trimTime, len(files), 'files')
+        start = time.perf_counter()
+        removed = quietly(treeCleanup, excess, parent)
+        record(' - cleanup', time.perf_counter() - start, removed[0], 'files')
+        ok = ok and removed[0] == listStat(diff['deleted'])
+    finally:
+        shutil.rmtree(root, ignore_errors = True)
+    print(' - consistent counts: %s' % ok)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({ 'files' : len(files), 'directories' : directories, 'results' : results }, f, indent = 1)
+        print('Results written to %s' % args.output)
+    return 0 if ok else 1
+
+def benchParse(args):
+    listing = generateListing(args.rows, args.rows // 20)
+    url = 'http://mirror.example/debian/pool/main/p/'
+    for server, page in [('Apache', apachePage('/debian/pool/main/p/', listing)), ('nginx', nginxPage('/debian/pool/main/p/', listing))]:
+        print('%s listing, %d rows, %d bytes' % (server, args.rows, len(page)))
+        soupTime, soupIndex = timeIt(parseIndexContent_Soup, url, 'text/html', server, page, repeat = args.repeat)
+        streamTime, streamIndex = timeIt(parseIndexContent, url, 'text/html', server, page, repeat = args.repeat)
+        report(' - BeautifulSoup', soupTime, args.rows, 'rows')
+        report(' - streaming', streamTime, args.rows, 'rows')
+        print(' - speed-up: %.1fx, identical output: %s' % (soupTime / streamTime, soupIndex == streamIndex))
+        if soupIndex != streamIndex:
+            return 1
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='httpsync benchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    parse = subparsers.add_parser('parse', help='Auto-index parsers: streaming versus BeautifulSoup.')
+    parse.add_argument('--rows', type=int, default=5000, help='Rows per generated listing page.')
+    parse.add_argument('--repeat', type=int, default=3, help='Runs per parser (best is reported).')
+    parse.set_defaults(func=benchParse)
+    diff = subparsers.add_parser('diff', help='Index diff: single-pass merge-join versus the process-based diffs.')
+    diff.add_argument('--files', type=int, default=500000, help='Files in the generated index.')
+    diff.add_argument('--dirs', type=int, default=2000, help='Directories holding the files.')
+    diff.add_argument('--changes', type=float, default=0.01, help='Fraction of files added, deleted and updated (each).')
+    diff.add_argument('--repeat', type=int, default=3, help='Runs of the merge-join diff (best is reported).')
+    diff.add_argument('--no-legacy', dest='legacy', action='store_false', help='Skip the (slow) process-based diffs.')
+    diff.set_defaults(func=benchDiff)
+    scan = subparsers.add_parser('scan', help='Destination scan: threaded os.scandir versus os.walk + stat.')
+    scan.add_argument('--files', type=int, default=200000, help='Files in the generated tree.')
+    scan.add_argument('--dirs', type=int, default=2000, help='Directories holding the files.')
+    scan.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32], help='Thread pool sizes to try.')
+    scan.add_argument('--repeat', type=int, default=3, help='Runs per scanner (best is reported).')
+    scan.add_argument('--path', type=str, help='Scan an existing tree instead of generating one.')
+    scan.add_argument('--keep', action='store_true', help='Keep the generated tree.')
+    scan.set_defaults(func=benchScan)
+    index = subparsers.add_parser('index', help='In-memory index: slotted Index versus nested dicts.')
+    index.add_argument('--files', type=int, default=500000, help='Files in the generated index.')
+    index.add_argument('--dirs', type=int, default=2000, help='Directories holding the files.')
+    index.add_argument('--lookups', type=int, default=10000, help='Random files looked up by path.')
+    index.add_argument('--names', type=int, default=50, help='File names searched (linear scan versus FileLookup, tables included).')
+    index.add_argument('--repeat', type=int, default=3, help='Runs per operation (best is reported).')
+    index.set_defaults(func=benchIndex)
+    mirror = subparsers.add_parser('mirror', help='End to end on a generated APT-like mirror: crawl, diff, scan, trim and cleanup.')
+    mirror.add_argument('--packages', type=int, default=20000, help='Packages in "pool" (1 to 3 versions each).')
+    mirror.add_argument('--dists', type=int, default=3, help='Distributions in "dists".')
+    mirror.add_argument('--sizes', choices=SIZE_DISTRIBUTIONS, default='lognormal', help='File size distribution.')
+    mirror.add_argument('--mean-size', type=int, default=1 << 18, help='Mean package size in bytes.')
+    mirror.add_argument('--changes', type=float, default=0.01, help='Fraction of files added, deleted and updated (each) between crawls.')
+    mirror.add_argument('--servers', choices=list(SERVER_PRODUCTS.keys()), nargs='+', default=['apache', 'nginx'], help='Autoindex styles served.')
+    mirror.add_argument('--engines', choices=['threaded', 'async'], nargs='+', default=['threaded', 'async'], help='Crawling engines.')
+    mirror.add_argument('--connections', type=int, default=8, help='Crawler connections.')
+    mirror.add_argument('--repeat', type=int, default=1, help='Runs per stage, cleanup excepted (best is reported).')
+    mirror.add_argument('--output', type=str, help='Also write the results as JSON, for comparison between commits.')
+    mirror.set_defaults(func=benchMirror)
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+'''
+Content-addressed store of hardlinks, shared by every tree mirrored on the
+same filesystem: a file already mirrored elsewhere (same size & SHA256, or
+same name, listed size & timestamp when no hash is known) is linked into place
+instead of being downloaded again
+'''
+
+# python 3.9 and onward required
+
+import os
+import errno
+import hashlib
+from pathlib import Path
+from verify import hashFile
+from pathtools import indexFiles
+
+def exactSize(entry):
+    size = entry.get('file', '')
+    return int(size) if size.isdigit() else None
+
+class ContentStore:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.enabled = True
+        self.linked = 0
+        self.ingested = 0
+    def objectPath(self, entry):
+        size = entry.get('file', '')
+        if 'sha256' in entry:
+            return self.path / 'sha256' / entry['sha256'][:2] / ('%s-%s' % (entry['sha256'], size))
+        if entry.get('timestamp', '') == '':
+            return None
+        # listing sizes are rounded ("1.2M"): the name narrows the key down
+        name = entry['url'].rsplit('/', 1)[1]
+        digest = hashlib.sha256(('%s\0%s\0%s' % (name, size, entry['timestamp'])).encode('utf-8')).hexdigest()
+        return self.path / 'stamp' / digest[:2] / digest
+    def storedObject(self, entry):
+        # rounded sizes: the object name ends with the bytes it was ingested with
+        obj = self.objectPath(entry)
+        if obj is None or 'sha256' in entry or exactSize(entry) is not None or obj.is_file():
+            return obj
+        for candidate in obj.parent.glob(obj.name + '-*'):
+            return candidate
+        return obj
+    def failed(self, e):
+        if e.errno == errno.EXDEV:
+            print('Content store is on another filesystem, disabled: %s' % str(self.path))
+            self.enabled = False
+        else:
+            print('Content store error: %s' % str(e))
+    def link(self, entry, path):
+        '''Hardlinks the stored copy to path; returns False when it must be downloaded'''
+        if not self.enabled:
+            return False
+        obj = self.storedObject(entry)
+        try:
+            if obj is None or not obj.is_file():
+                # never let a downloader rewrite an inode shared with other trees
+                if path.is_file() and path.stat().st_nlink > 1:
+                    path.unlink()
+                return False
+            size = exactSize(entry)
+            if size is not None and obj.stat().st_size != size:
+                return False
+            if path.is_file() and os.path.samefile(str(obj), str(path)):
+                return True
+            path.parent.mkdir(parents = True, exist_ok = True)
+            tmp = path.with_name('.' + path.name + '.link')
+            if tmp.exists():
+                tmp.unlink()
+            os.link(str(obj), str(tmp))
+            os.replace(str(tmp), str(path))
+        except OSError as e:
+            self.failed(e)
+            return False
+        self.linked += 1
+        return True
+    def ingest(self, entry, path):
+        # a downloaded file joins the store once checked against its key
+        if not self.enabled:
+            return False
+        obj = self.objectPath(entry)
+        try:
+            if obj is None or not path.is_file():
+                return False
+            # aria2 keeps its control file until the download is complete
+            if path.with_name(path.name + '.aria2').exists():
+                return False
+            size = exactSize(entry)
+            if size is None and 'sha256' not in entry:
+                # a rounded listing size: the finished download is keyed by
+                # its own size
+                if self.storedObject(entry) != obj:
+                    return False
+                obj = obj.with_name('%s-%d' % (obj.name, path.stat().st_size))
+            if obj.exists():
+                return False
+            if size is not None and path.stat().st_size != size:
+                return False
+            if 'sha256' in entry and hashFile(str(path)) != entry['sha256']:
+                return False
+            obj.parent.mkdir(parents = True, exist_ok = True)
+            os.link(str(path), str(obj))
+        except FileExistsError:
+            return False
+        except OSError as e:
+            self.failed(e)
+            return False
+        self.ingested += 1
+        return True
+    def linkIndex(self, index, parent):
+        '''Links every stored file of index under parent; returns the index
+        of the files left to download'''
+        remaining = {}
+        for entry, path in indexFiles(index, parent):
+            if self.link(entry, path):
+                continue
+            vect = remaining
+            for key in path.parent.relative_to(parent).parts:
+                if key not in vect:
+                    vect[key] = {}
+                vect = vect[key]
+            if 'files' not in vect:
+                vect['files'] = []
+            vect['files'].append(entry)
+        return remaining
+    def ingestIndex(self, index, parent):
+        for entry, path in indexFiles(index, parent):
+            self.ingest(entry, path)
+        return self.ingested
+    def prune(self):
+        # objects no mirrored tree links to anymore
+        removed = 0
+        for kind in ['sha256', 'stamp']:
+            for root, dirs, files in os.walk(str(self.path / kind)):
+                for name in files:
+                    p = os.path.join(root, name)
+                    try:
+                        if os.stat(p).st_nlink == 1:
+                            os.remove(p)
+                            removed += 1
+                    except OSError:
+                        pass
+        return removed
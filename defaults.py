@@ -13,12 +13,25 @@ class generalDefaults(Constants):
     cache = Path.home() / 'httpsync_cache'
     whitelist = []
     blacklist = []
+    crawler = 'process'
+    connections = 16
+    indexer = 'html'
+    listing_cache = True
+    incremental = False
+    verify = 'off'
+    index_format = 'json'
+    diff_memory = 0
+    pipeline = False
+    downloader = 'aria2'
+    store = ''
+    journal = True
 
 class aria2Defaults(Constants):
     detach = False
     listen_all = False
     port = 6800
     secret = ''
+    batch_size = 1000
 
 def_general = generalDefaults()
 def_aria2 = aria2Defaults()
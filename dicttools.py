@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+from fileindex import Index
+
 def indepthDictUpdate(A, B):
     if type(B) is dict and type(A) is dict:
         for key in B.keys():
@@ -36,9 +38,46 @@ def filesTree(tree, path = []):
                 lst += filesTree(tree[key], path + [key])
     return lst
 
+# fresh nested index holding the entries of all given indices
+def mergeIndices(*indices):
+    merged = {}
+    for index in indices:
+        if index is None:
+            continue
+        for path in filesTree(index):
+            vect = merged
+            for key in path[:-1]:
+                if key not in vect:
+                    vect[key] = {}
+                vect = vect[key]
+            if 'files' not in vect:
+                vect['files'] = []
+            vect['files'] += transverseDict(index, path)
+    return merged
+
+# (relative path, entry) of every file, in no particular order
+def iterFiles(index, prefix = ''):
+    if index is None:
+        return
+    if isinstance(index, Index):
+        yield from index.items()
+        return
+    for key in index.keys():
+        if key == 'files':
+            for entry in index[key]:
+                yield prefix + entry['url'].rsplit('/', 1)[1], entry
+        else:
+            yield from iterFiles(index[key], prefix + key + '/')
+
 def listStat(index):
+    if index is None:
+        return 0
+    if isinstance(index, Index):
+        return len(index)
     count = 0
-    filesPath = filesTree(index)
-    for path in filesPath:
-        count += len(transverseDict(index, path))
+    for key in index.keys():
+        if key == 'files':
+            count += len(index[key])
+        else:
+            count += listStat(index[key])
     return count
@@ -8,7 +8,9 @@ from pathlib import Path
 import subprocess
 import multiprocessing as mp
 from pathtools import changedir, fileCleanup
-from dicttools import indepthDictUpdate, transverseDict, filesTree
+from dicttools import indepthDictUpdate, transverseDict, filesTree, iterFiles
+from packedindex import iterIndex, PackedIndex
+from extsort import ExternalSorter
 
 def prepareDiffStructure(filesList, urlOnly = False):
     filesStrList = []
@@ -158,3 +160,83 @@ def diffIndices_Threaded(indexA, indexB, urlOnly = False, maxThreads = 64):
                     processes.pop(threads)
     # return
     return diffIndex
+
+def indexStream(index):
+    # sorted (relative path, entry) pairs of a nested or packed index
+    if index is None:
+        return iter(())
+    if type(index) is dict:
+        return iterIndex(index)
+    return iter(index)
+
+def mergeJoinIndices(streamA, streamB):
+    '''Single pass over two path-sorted streams; yields
+    (category, relative path, entry in A, entry in B)'''
+    a = next(streamA, None)
+    b = next(streamB, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield 'deleted', a[0], a[1], None
+            a = next(streamA, None)
+        elif a is None or b[0] < a[0]:
+            yield 'added', b[0], None, b[1]
+            b = next(streamB, None)
+        else:
+            yield ('unchanged' if a[1] == b[1] else 'updated'), a[0], a[1], b[1]
+            a = next(streamA, None)
+            b = next(streamB, None)
+
+def insertRelative(tree, path, entry):
+    vect = tree
+    keys = path.split('/')
+    for key in keys[:-1]:
+        if key not in vect:
+            vect[key] = {}
+        vect = vect[key]
+    if 'files' not in vect:
+        vect['files'] = []
+    vect['files'].append(entry)
+
+def diffIndices_MergeJoin(indexA, indexB, pathOnly = False):
+    '''Classifies every file of indexA (old) and indexB (new) as added,
+    deleted, updated (entry of B) or unchanged in one in-process pass.
+    With pathOnly, entries on the same path are always unchanged.'''
+    diff = {
+        'added' : {},
+        'deleted' : {},
+        'updated' : {},
+        'unchanged' : {}
+    }
+    for category, path, entryA, entryB in mergeJoinIndices(indexStream(indexA), indexStream(indexB)):
+        if pathOnly and category == 'updated':
+            category = 'unchanged'
+        insertRelative(diff[category], path, entryA if category == 'deleted' else entryB)
+    return diff
+
+def diffIndices_External(indexA, indexB, working_dir, memory_limit = 64 << 20, pathOnly = False, keepUnchanged = False):
+    '''Out-of-core diffIndices_MergeJoin: unsorted inputs (nested indices or
+    iterables of (relative path, entry)) are spilled as sorted runs under
+    working_dir and k-way merged, using about memory_limit bytes. Unchanged
+    files are only collected with keepUnchanged.'''
+    diff = {
+        'added' : {},
+        'deleted' : {},
+        'updated' : {},
+        'unchanged' : {}
+    }
+    with ExternalSorter(working_dir, memory_limit // 2) as sortedA, ExternalSorter(working_dir, memory_limit // 2) as sortedB:
+        streams = []
+        for index, sorter in [(indexA, sortedA), (indexB, sortedB)]:
+            if isinstance(index, PackedIndex):
+                # already sorted on disk
+                streams.append(iter(index))
+            else:
+                sorter.extend(iterFiles(index) if type(index) is dict or index is None else index)
+                streams.append(iter(sorter))
+        for category, path, entryA, entryB in mergeJoinIndices(streams[0], streams[1]):
+            if pathOnly and category == 'updated':
+                category = 'unchanged'
+            if category == 'unchanged' and not keepUnchanged:
+                continue
+            insertRelative(diff[category], path, entryA if category == 'deleted' else entryB)
+    return diff
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+'''
+Downloader interface: files are queued with add(url, directory) and
+wait() returns once every queued file is finished (or given up)
+
+Backends: Aria2Downloader (aria2 RPC) and asyncfetch.AsyncDownloader
+'''
+
+# python 3.9 and onward required
+
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from fetch import BatchSubmitter, FetchTracker, BATCH_SIZE
+from metrics import registry
+
+class Downloader(ABC):
+    def start(self):
+        return self
+    @abstractmethod
+    def add(self, url, directory):
+        pass
+    def flush(self):
+        # hands queued files over to the backend
+        pass
+    @abstractmethod
+    def wait(self):
+        pass
+    def stop(self):
+        pass
+    def addFiles(self, files, directory):
+        for file in files:
+            self.add(file['url'], str(directory))
+        return len(files)
+    def addIndex(self, index, parent):
+        '''Queues every file of index under parent; returns their number'''
+        count = 0
+        if 'files' in index:
+            count += self.addFiles(index['files'], parent)
+        for subdir in list(index.keys()):
+            if subdir != 'files':
+                count += self.addIndex(index[subdir], Path(parent) / subdir)
+        self.flush()
+        return count
+    def __enter__(self):
+        return self.start()
+    def __exit__(self, *args):
+        self.stop()
+
+class Aria2Downloader(Downloader):
+    '''Batched addUri calls, completions followed through aria2 notifications'''
+    def __init__(self, aria2, batchSize = BATCH_SIZE):
+        self.aria2 = aria2
+        self.submitter = BatchSubmitter(aria2, batchSize)
+        self.tracker = FetchTracker(aria2, batchSize = batchSize)
+        # the pipelines of several repositories add files concurrently
+        self.lock = threading.RLock()
+    def start(self):
+        self.tracker.start()
+        return self
+    def add(self, url, directory):
+        registry.count('download_requests', result = 'queued')
+        with self.lock, self.tracker.submitting():
+            self.submitter.add(url, { 'dir' : directory })
+            if len(self.submitter.gids) > 0:
+                self.flush()
+    def flush(self):
+        with self.lock, self.tracker.submitting():
+            self.submitter.flush()
+            gids = self.submitter.gids
+            self.submitter.gids = []
+            self.tracker.add(gids)
+    def wait(self):
+        self.flush()
+        self.tracker.wait()
+    def stop(self):
+        self.tracker.stop()
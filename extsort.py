@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+'''
+External (out-of-core) sort of (relative path, entry) pairs: sorted runs
+are spilled to a working directory and k-way merged back
+'''
+
+# python 3.9 and onward required
+
+import os
+import json
+import heapq
+import shutil
+import tempfile
+from pathlib import Path
+
+# runs merged at once; more runs are merged in several passes
+MAX_FAN_IN = 64
+READ_BUFFER = 1 << 16
+
+def writeRun(items, path):
+    items.sort(key = lambda item: item[0])
+    with open(path, 'w', encoding='utf-8') as f:
+        for item in items:
+            f.write(json.dumps(item, sort_keys=True))
+            f.write('\n')
+
+def readRun(path):
+    with open(path, 'r', encoding='utf-8', buffering=READ_BUFFER) as f:
+        for line in f:
+            item = json.loads(line)
+            yield item[0], item[1]
+
+def mergeRuns(runs):
+    return heapq.merge(*[readRun(run) for run in runs], key = lambda item: item[0])
+
+class ExternalSorter:
+    '''Sorts pairs by path using at most about memory_limit bytes of
+    serialised entries in memory; iterate it once to get the sorted pairs'''
+    def __init__(self, working_dir, memory_limit = 64 << 20):
+        Path(working_dir).mkdir(parents=True, exist_ok=True)
+        self.dir = tempfile.mkdtemp(prefix='extsort-', dir=str(working_dir))
+        self.limit = memory_limit
+        self.runs = []
+        self.items = []
+        self.used = 0
+        self.count = 0
+    def runPath(self):
+        return os.path.join(self.dir, 'run%06d' % self.count)
+    def spill(self):
+        if len(self.items) > 0:
+            path = self.runPath()
+            self.count += 1
+            writeRun(self.items, path)
+            self.runs.append(path)
+            self.items = []
+            self.used = 0
+    def add(self, path, entry):
+        self.items.append([path, entry])
+        # rough footprint: path, entry strings and object overhead
+        self.used += len(path) + sum(len(key) + len(str(value)) for key, value in entry.items()) + 256
+        if self.used >= self.limit:
+            self.spill()
+    def extend(self, pairs):
+        for path, entry in pairs:
+            self.add(path, entry)
+        return self
+    def __iter__(self):
+        if len(self.runs) == 0:
+            # everything fitted in memory
+            self.items.sort(key = lambda item: item[0])
+            for path, entry in self.items:
+                yield path, entry
+            return
+        self.spill()
+        # multi-pass merge keeps the number of open files bounded
+        while len(self.runs) > MAX_FAN_IN:
+            runs = self.runs
+            self.runs = []
+            for i in range(0, len(runs), MAX_FAN_IN):
+                path = self.runPath()
+                self.count += 1
+                with open(path, 'w', encoding='utf-8') as f:
+                    for item in mergeRuns(runs[i:i + MAX_FAN_IN]):
+                        f.write(json.dumps(list(item), sort_keys=True))
+                        f.write('\n')
+                for run in runs[i:i + MAX_FAN_IN]:
+                    os.remove(run)
+                self.runs.append(path)
+        yield from mergeRuns(self.runs)
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.cleanup()
@@ -2,46 +2,229 @@
 
 # python 3.9 and onward required
 
+import time
+import threading
+from contextlib import contextmanager
 import aria2p
+from fileindex import Index
+from metrics import registry
+
+# addUri calls per system.multicall request
+BATCH_SIZE = 1000
+# seconds between tellStatus passes, with and without notifications
+RECONCILE_INTERVAL = 30
+POLL_INTERVAL = 2
+MAX_RETRIES = 5
 
 def searchURL(index, filename):
-    for path in filesTree(index):
-        for file in transverseDict(index, path):
-            pos = file['url'].find(filename)
-            if pos > 0 and pos < len(file['url']):
-                return file['url']
+    '''URL of the file named filename (a basename or the end of its path),
+    None if absent; pass an Index to resolve many names, its lookup tables
+    are kept between calls'''
+    if not isinstance(index, Index):
+        index = Index.fromDict(index)
+    for relpath in index.lookup().search(filename):
+        return index.base + relpath
     return None
 
-def waitForAllFetches(aria2):
-    fetches = aria2.get_downloads()
-    while len(fetches) > 0:
-        fails = []
-        for fetch in fetches:
-            try:
-                fetch.update()
-                if fetch.has_failed:
-                    print('Will retry: %s' % fetch.name)
-                    fails.append(fetch)
-            except:
-                pass
-        if len(fails) > 0:
-            aria2.retry_downloads(fails, clean=True)
-        aria2.purge()
-        fetches = aria2.get_downloads()
-
-def fileListDownload(aria2, files, options):
-    downloads = []
-    for file in files:
-        downloads.append(aria2.add_uris([file['url'],], options=options))
-    return downloads
-
-def indexDownload(aria2, index, parent):
-    downloads = []
+class FetchTracker:
+    '''Keeps the GIDs of queued downloads until aria2 reports them finished.
+    Completions and errors come from the WebSocket notifications; a tellStatus
+    pass every "interval" seconds catches anything the notifications missed'''
+    def __init__(self, aria2, interval = RECONCILE_INTERVAL, batchSize = BATCH_SIZE):
+        self.aria2 = aria2
+        self.interval = interval
+        self.batchSize = batchSize
+        self.outstanding = set()
+        # notifications for GIDs not added yet (still in a multicall reply),
+        # only kept while a submission is in flight
+        self.early = {}
+        self.inflight = 0
+        self.failed = []
+        self.retries = {}
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.listener = None
+    def listen(self):
+        try:
+            self.aria2.client.listen_to_notifications(
+                on_download_stop = lambda gid: self.notified(gid, False),
+                on_download_complete = lambda gid: self.notified(gid, False),
+                on_bt_download_complete = lambda gid: self.notified(gid, False),
+                on_download_error = lambda gid: self.notified(gid, True),
+                timeout = 1, handle_signals = False)
+        except Exception as e:
+            print('aria2 notifications unavailable, polling instead: %s' % str(e).splitlines()[0])
+    def start(self):
+        self.listener = threading.Thread(target = self.listen, daemon = True)
+        self.listener.start()
+        return self
+    def stop(self):
+        self.aria2.client.stop_listening()
+        if self.listener is not None:
+            self.listener.join(timeout = 5)
+            self.listener = None
+    def __enter__(self):
+        return self.start()
+    def __exit__(self, *args):
+        self.stop()
+    def notified(self, gid, failed):
+        with self.lock:
+            if gid in self.outstanding:
+                self.outstanding.discard(gid)
+                if failed:
+                    self.failed.append(gid)
+            elif self.inflight > 0:
+                self.early[gid] = failed
+        self.event.set()
+    @contextmanager
+    def submitting(self):
+        '''Wraps addUri calls and the add() of their GIDs: notifications
+        nobody claimed by then belong to other clients of aria2'''
+        with self.lock:
+            self.inflight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.inflight -= 1
+                if self.inflight == 0:
+                    self.early.clear()
+    def add(self, gids):
+        with self.lock:
+            for gid in gids:
+                if gid in self.early:
+                    if self.early.pop(gid):
+                        self.failed.append(gid)
+                else:
+                    self.outstanding.add(gid)
+        return gids
+    def pending(self):
+        with self.lock:
+            return len(self.outstanding) + len(self.failed)
+    def reconcile(self):
+        with self.lock:
+            gids = list(self.outstanding)
+        client = self.aria2.client
+        for i in range(0, len(gids), self.batchSize):
+            batch = gids[i:i + self.batchSize]
+            results = client.multicall2([(client.TELL_STATUS, [gid, ['gid', 'status']]) for gid in batch])
+            for gid, result in zip(batch, results):
+                if type(result) is not list:
+                    # result already purged: nothing left to wait for
+                    self.notified(gid, False)
+                elif result[0]['status'] in ['complete', 'removed']:
+                    self.notified(gid, False)
+                elif result[0]['status'] == 'error':
+                    self.notified(gid, True)
+    def retryFailed(self):
+        with self.lock:
+            failed = self.failed
+            self.failed = []
+        if len(failed) == 0:
+            return
+        client = self.aria2.client
+        with self.submitting():
+            with BatchSubmitter(self.aria2, self.batchSize) as submitter:
+                for gid in failed:
+                    try:
+                        status = client.tell_status(gid, ['files', 'dir'])
+                        url = status['files'][0]['uris'][0]['uri']
+                    except Exception:
+                        continue
+                    self.retries[url] = self.retries.get(url, 0) + 1
+                    if self.retries[url] > MAX_RETRIES:
+                        print('Giving up: %s' % url)
+                        registry.count('download_requests', result = 'failed')
+                    else:
+                        print('Will retry: %s' % url)
+                        registry.count('download_requests', result = 'retried')
+                        submitter.add(url, { 'dir' : status['dir'] })
+                    client.remove_download_result(gid)
+            self.add(submitter.gids)
+    def wait(self):
+        with registry.timer('download_wait_seconds', downloader = 'aria2'):
+            self.waitAll()
+    def waitAll(self):
+        nextCheck = time.monotonic() + self.interval
+        while True:
+            self.event.clear()
+            self.retryFailed()
+            if self.pending() == 0:
+                break
+            interval = self.interval
+            if self.listener is None or not self.listener.is_alive():
+                interval = POLL_INTERVAL
+                nextCheck = min(nextCheck, time.monotonic() + interval)
+            remaining = nextCheck - time.monotonic()
+            if remaining <= 0:
+                self.reconcile()
+                nextCheck = time.monotonic() + interval
+            else:
+                self.event.wait(remaining)
+        self.aria2.purge()
+
+def waitForAllFetches(aria2, gids = None):
+    # without GIDs, waits for everything active or waiting in aria2
+    if gids is None:
+        client = aria2.client
+        gids = [d['gid'] for d in client.tell_active(['gid']) + client.tell_waiting(0, 1 << 30, ['gid'])]
+    with FetchTracker(aria2) as tracker:
+        tracker.add(gids)
+        tracker.wait()
+
+class BatchSubmitter:
+    '''Queues aria2.addUri calls and sends them through system.multicall,
+    batchSize calls per request'''
+    def __init__(self, aria2, batchSize = BATCH_SIZE):
+        self.client = aria2.client
+        self.batchSize = max(1, batchSize)
+        self.calls = []
+        self.gids = []
+        self.failed = 0
+    def add(self, url, options):
+        self.calls.append((self.client.ADD_URI, [[url,], options]))
+        if len(self.calls) >= self.batchSize:
+            self.flush()
+    def flush(self):
+        if len(self.calls) == 0:
+            return
+        calls = self.calls
+        self.calls = []
+        results = self.client.multicall2(calls)
+        # a successful call answers [gid], a failed one a fault struct
+        for (method, params), result in zip(calls, results):
+            if type(result) is list:
+                self.gids.append(result[0])
+            else:
+                self.failed += 1
+                registry.count('download_requests', result = 'rejected')
+                print('Cannot add %s: %s' % (params[0][0], result.get('message', result)))
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+def fileListDownload(aria2, files, options, batchSize = BATCH_SIZE):
+    if isinstance(options, aria2p.Options):
+        options = options.get_struct()
+    with BatchSubmitter(aria2, batchSize) as submitter:
+        for file in files:
+            submitter.add(file['url'], options)
+    return submitter.gids
+
+def queueIndex(submitter, index, parent):
     if 'files' in index:
-        options = aria2.get_global_options()
-        options.dir = str(parent)
-        downloads = downloads + fileListDownload(aria2, index['files'], options)
+        # every file of the directory shares one option struct; global options apply to the rest
+        options = { 'dir' : str(parent) }
+        for file in index['files']:
+            submitter.add(file['url'], options)
     for subdir in list(index.keys()):
         if subdir != 'files':
-            downloads = downloads + indexDownload(aria2, index[subdir], parent / subdir)
-    return downloads
+            queueIndex(submitter, index[subdir], parent / subdir)
+
+def indexDownload(aria2, index, parent, batchSize = BATCH_SIZE):
+    '''Queues every file of index under parent; returns the GIDs'''
+    with BatchSubmitter(aria2, batchSize) as submitter:
+        queueIndex(submitter, index, parent)
+    return submitter.gids
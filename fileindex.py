@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+'''
+In-memory index: slotted file records in a trie of directories, sizes,
+timestamps & hashes stored as numbers, counts kept up to date and sorted
+listing cached; imports and exports the nested dict format
+({ dir : { ..., 'files' : [entry, ...] } }) used by the rest of httpsync
+'''
+
+# python 3.9 and onward required
+
+import sys
+import json
+import bisect
+import fnmatch
+from pathlib import Path
+from packedindex import encodeSize, encodeStamp, decodeStamp, indexBase
+
+ENTRY_KEYS = ('file', 'timestamp', 'url', 'sha256')
+
+class FileRecord:
+    '''One file: size is bytes (int) or a listing size such as "1.2M",
+    stamp is UTC epoch seconds (int), a string or None when missing,
+    sha256 is the raw digest; the URL is rebuilt from the index base'''
+    __slots__ = ('node', 'name', 'size', 'stamp', 'sha256', 'extra')
+    def __init__(self, node, name, entry):
+        self.node = node
+        self.name = name
+        self.extra = None
+        size = entry.get('file')
+        value = None if size is None else encodeSize(size)
+        if value is not None:
+            self.size = value
+        else:
+            self.size = None if size is None else sys.intern(size)
+        stamp = entry.get('timestamp')
+        if stamp is not None:
+            value = encodeStamp(stamp)
+            stamp = sys.intern(stamp) if value is None else value
+        self.stamp = stamp
+        self.sha256 = None
+        sha256 = entry.get('sha256')
+        if sha256 is not None:
+            try:
+                self.sha256 = bytes.fromhex(sha256)
+            except ValueError:
+                self.extra = { 'sha256' : sha256 }
+        for key in entry.keys():
+            if key not in ENTRY_KEYS:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = entry[key]
+    def exactSize(self):
+        return self.size if type(self.size) is int else None
+    def path(self):
+        return self.node.path() + self.name
+    def entry(self, base):
+        # same dict (and key order) as the crawlers & PackedIndex.entry
+        entry = {}
+        if self.size is not None:
+            entry['file'] = ('%d' % self.size) if type(self.size) is int else self.size
+        if self.stamp is not None:
+            entry['timestamp'] = decodeStamp(self.stamp) if type(self.stamp) is int else self.stamp
+        entry['url'] = base + self.path()
+        if self.sha256 is not None:
+            entry['sha256'] = self.sha256.hex()
+        if self.extra is not None:
+            entry.update(self.extra)
+        return entry
+
+class DirNode:
+    __slots__ = ('parent', 'name', 'dirs', 'files')
+    def __init__(self, parent = None, name = ''):
+        self.parent = parent
+        self.name = name
+        # created on demand: most directories hold only one kind
+        self.dirs = None
+        self.files = None
+    def path(self):
+        # relative path with a trailing '/', '' for the root
+        parts = []
+        node = self
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+        return ''.join(name + '/' for name in reversed(parts))
+
+class Index:
+    '''Files of a mirrored tree by relative path (URL = base + path)'''
+    def __init__(self, base = ''):
+        self.base = base
+        self.root = DirNode()
+        self.count = 0
+        self.bytes = 0
+        self.directories = 0
+        # bumped by every change, drops the cached listing & lookup tables
+        self.version = 0
+        self.listing = None
+        self.names = None
+    def __len__(self):
+        return self.count
+    def __contains__(self, relpath):
+        return self.record(relpath) is not None
+    def __iter__(self):
+        return self.items()
+    def node(self, dirpath, create = False):
+        node = self.root
+        if dirpath == '':
+            return node
+        for name in dirpath.split('/'):
+            child = None if node.dirs is None else node.dirs.get(name)
+            if child is None:
+                if not create:
+                    return None
+                if node.dirs is None:
+                    node.dirs = {}
+                child = DirNode(node, sys.intern(name))
+                node.dirs[child.name] = child
+                self.directories += 1
+            node = child
+        return node
+    def record(self, relpath):
+        dirpath, sep, name = relpath.rpartition('/')
+        node = self.node(dirpath)
+        if node is None or node.files is None:
+            return None
+        return node.files.get(name)
+    def get(self, relpath, default = None):
+        record = self.record(relpath)
+        return default if record is None else record.entry(self.base)
+    def add(self, relpath, entry):
+        '''Adds or replaces the file at relpath'''
+        dirpath, sep, name = relpath.rpartition('/')
+        node = self.node(dirpath, create = True)
+        if node.files is None:
+            node.files = {}
+        record = FileRecord(node, name, entry)
+        previous = node.files.get(name)
+        if previous is None:
+            self.count += 1
+        else:
+            self.bytes -= previous.exactSize() or 0
+        self.bytes += record.exactSize() or 0
+        node.files[name] = record
+        self.changed()
+        return record
+    def remove(self, relpath):
+        dirpath, sep, name = relpath.rpartition('/')
+        node = self.node(dirpath)
+        if node is None or node.files is None or name not in node.files:
+            return False
+        record = node.files.pop(name)
+        self.count -= 1
+        self.bytes -= record.exactSize() or 0
+        if len(node.files) == 0:
+            node.files = None
+        # directories left empty go too
+        while node.parent is not None and node.files is None and node.dirs is None:
+            parent = node.parent
+            del parent.dirs[node.name]
+            if len(parent.dirs) == 0:
+                parent.dirs = None
+            self.directories -= 1
+            node = parent
+        self.changed()
+        return True
+    def changed(self):
+        self.version += 1
+        self.listing = None
+    def records(self):
+        '''(relative path, FileRecord) sorted like packedindex.iterIndex;
+        cached until the index changes'''
+        if self.listing is None:
+            listing = []
+            def walk(node, prefix):
+                items = []
+                if node.files is not None:
+                    for name, record in node.files.items():
+                        items.append((prefix + name, record))
+                if node.dirs is not None:
+                    for name, child in node.dirs.items():
+                        items.append((prefix + name + '/', child))
+                items.sort(key = lambda item: item[0])
+                for path, item in items:
+                    if type(item) is DirNode:
+                        walk(item, path)
+                    else:
+                        listing.append((path, item))
+            walk(self.root, '')
+            self.listing = listing
+        return self.listing
+    def lookup(self):
+        # FileLookup of this index, kept across calls
+        if self.names is None:
+            self.names = FileLookup(self)
+        return self.names
+    def items(self):
+        # (relative path, entry) like packedindex.iterIndex
+        for relpath, record in self.records():
+            yield relpath, record.entry(self.base)
+    def stat(self):
+        return { 'files' : self.count, 'directories' : self.directories, 'bytes' : self.bytes }
+    @classmethod
+    def fromItems(cls, items, base = ''):
+        index = cls(base)
+        for relpath, entry in items:
+            index.add(relpath, entry)
+        return index
+    @classmethod
+    def fromDict(cls, tree, base = None):
+        if base is None:
+            base = indexBase(tree)
+        index = cls(base)
+        def walk(tree, node):
+            for key in tree.keys():
+                if key == 'files':
+                    if node.files is None:
+                        node.files = {}
+                    for entry in tree[key]:
+                        name = entry['url'].rsplit('/', 1)[1]
+                        previous = node.files.get(name)
+                        if previous is None:
+                            index.count += 1
+                        else:
+                            index.bytes -= previous.exactSize() or 0
+                        record = FileRecord(node, name, entry)
+                        index.bytes += record.exactSize() or 0
+                        node.files[name] = record
+                else:
+                    if node.dirs is None:
+                        node.dirs = {}
+                    child = node.dirs.get(key)
+                    if child is None:
+                        child = DirNode(node, sys.intern(key))
+                        node.dirs[child.name] = child
+                        index.directories += 1
+                    walk(tree[key], child)
+        walk(tree, index.root)
+        return index
+    def toDict(self):
+        def walk(node):
+            tree = {}
+            if node.dirs is not None:
+                for name, child in node.dirs.items():
+                    tree[name] = walk(child)
+            if node.files is not None:
+                tree['files'] = [record.entry(self.base) for record in node.files.values()]
+            return tree
+        return walk(self.root)
+    @classmethod
+    def load(cls, path):
+        with Path(path).open('r') as f:
+            return cls.fromDict(json.load(f))
+    def save(self, path):
+        with Path(path).open('w') as f:
+            json.dump(self.toDict(), f)
+
+class FileLookup:
+    '''Finds files of an Index by name: exact basenames through a hash map,
+    prefixes, suffixes & glob patterns through sorted name tables; tables
+    are built on first use and again after the index changes'''
+    def __init__(self, index):
+        self.index = index
+        self.version = None
+        self.byName = None
+        self.sortedNames = None
+        self.reversedNames = None
+    def refresh(self):
+        if self.version != self.index.version:
+            self.version = self.index.version
+            self.byName = None
+            self.sortedNames = None
+            self.reversedNames = None
+    def nameMap(self):
+        self.refresh()
+        if self.byName is None:
+            byName = {}
+            for relpath, record in self.index.records():
+                paths = byName.get(record.name)
+                if paths is None:
+                    byName[record.name] = [relpath]
+                else:
+                    paths.append(relpath)
+            self.byName = byName
+        return self.byName
+    def find(self, name):
+        '''Relative paths of the files named name'''
+        return list(self.nameMap().get(name, []))
+    def search(self, name):
+        # name is a basename or the end of a path ("bash/bash_5.1_armhf.deb")
+        basename = name.rsplit('/', 1)[-1]
+        paths = self.nameMap().get(basename, [])
+        if '/' not in name:
+            return list(paths)
+        return [relpath for relpath in paths if relpath == name or relpath.endswith('/' + name)]
+    def prefix(self, prefix):
+        '''Relative paths of the files whose name starts with prefix'''
+        nameMap = self.nameMap()
+        if self.sortedNames is None:
+            self.sortedNames = sorted(nameMap.keys())
+        names = self.sortedNames
+        paths = []
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            paths += nameMap[names[i]]
+            i += 1
+        return paths
+    def suffix(self, suffix):
+        '''Relative paths of the files whose name ends with suffix'''
+        nameMap = self.nameMap()
+        if self.reversedNames is None:
+            self.reversedNames = sorted(name[::-1] for name in nameMap.keys())
+        names = self.reversedNames
+        reverse = suffix[::-1]
+        paths = []
+        i = bisect.bisect_left(names, reverse)
+        while i < len(names) and names[i].startswith(reverse):
+            paths += nameMap[names[i][::-1]]
+            i += 1
+        return paths
+    def match(self, pattern):
+        '''Relative paths of the files whose name matches a glob pattern;
+        its literal head or tail narrows the candidates down'''
+        i = 0
+        while i < len(pattern) and pattern[i] not in '*?[':
+            i += 1
+        if i == len(pattern):
+            return self.find(pattern)
+        j = len(pattern)
+        while j > i and pattern[j - 1] not in '*?[]':
+            j -= 1
+        head = pattern[:i]
+        tail = pattern[j:]
+        if len(head) > 0 and len(head) >= len(tail):
+            candidates = self.prefix(head)
+        elif len(tail) > 0:
+            candidates = self.suffix(tail)
+        else:
+            candidates = [relpath for paths in self.nameMap().values() for relpath in paths]
+        return [relpath for relpath in candidates if fnmatch.fnmatchcase(relpath.rsplit('/', 1)[-1], pattern)]
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+'''
+Streaming index persistence: one JSON line per file (NDJSON), optionally
+gzip (".ndjson.gz") or zstd (".ndjson.zst", needs "zstandard") compressed
+
+The first line holds the format version and the base URL; every other
+line is [relative path, entry without "url"].
+'''
+
+# python 3.9 and onward required
+
+import io
+import os
+import json
+import gzip
+from pathlib import Path
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMAT_VERSION = 1
+SUFFIXES = ['.ndjson', '.ndjson.gz', '.ndjson.zst']
+
+def isStreamIndex(path):
+    return any(str(path).endswith(suffix) for suffix in SUFFIXES)
+
+def requireZstd():
+    if zstandard is None:
+        raise ModuleNotFoundError('"zstandard" isn\'t installed (needed for .zst indices).')
+
+def openWrite(path):
+    p = str(path)
+    if p.endswith('.gz'):
+        return gzip.open(p, 'wt', encoding='utf-8', compresslevel=6)
+    elif p.endswith('.zst'):
+        requireZstd()
+        raw = open(p, 'wb')
+        return io.TextIOWrapper(zstandard.ZstdCompressor(level=6).stream_writer(raw, closefd=True), encoding='utf-8')
+    return open(p, 'w', encoding='utf-8')
+
+def openRead(path):
+    p = str(path)
+    if p.endswith('.gz'):
+        return gzip.open(p, 'rt', encoding='utf-8')
+    elif p.endswith('.zst'):
+        requireZstd()
+        raw = open(p, 'rb')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True), encoding='utf-8')
+    return open(p, 'r', encoding='utf-8')
+
+class IndexWriter:
+    '''Appends entries as they are discovered; the file replaces "path"
+    only when the writer is closed without error'''
+    def __init__(self, path, base):
+        self.path = Path(path)
+        self.base = base
+        # keep the compression suffix on the temporary file
+        self.tmp = self.path.with_name('.tmp-' + self.path.name)
+        self.file = openWrite(self.tmp)
+        self.file.write(json.dumps({ 'httpsync-index' : FORMAT_VERSION, 'base' : base }) + '\n')
+        self.count = 0
+    def write(self, entry):
+        url = entry['url']
+        if not url.startswith(self.base):
+            raise ValueError('Entry outside of the index base: %s' % url)
+        stripped = dict(entry)
+        del stripped['url']
+        self.file.write(json.dumps([url[len(self.base):], stripped], separators=(',', ':')) + '\n')
+        self.count += 1
+    def close(self):
+        self.file.close()
+        os.replace(str(self.tmp), str(self.path))
+    def abort(self):
+        self.file.close()
+        os.remove(str(self.tmp))
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def iterIndexFile(path):
+    '''Lazily yields (relative path, entry) in the order they were written'''
+    with openRead(path) as f:
+        header = json.loads(f.readline())
+        if header.get('httpsync-index') != FORMAT_VERSION:
+            raise ValueError('Unsupported index stream: %s' % str(path))
+        base = header['base']
+        for line in f:
+            relpath, entry = json.loads(line)
+            entry['url'] = base + relpath
+            yield relpath, entry
+
+def writeIndexFile(index_items, path, base):
+    with IndexWriter(path, base) as writer:
+        for relpath, entry in index_items:
+            writer.write(entry)
+        return writer.count
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+'''
+State journal of a mirrored tree (SQLite in the cache directory): every file
+fetched or deleted is recorded with its size, mtime and SHA256, so that the
+destination does not have to be rescanned to find excess or missing files
+'''
+
+# python 3.9 and onward required
+
+import time
+import sqlite3
+from pathlib import Path
+from pathtools import indexFiles
+from packedindex import buildIndex
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER, sha256 TEXT, updated INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+]
+
+class StateJournal:
+    def __init__(self, path, parent):
+        # parent: the mirrored tree, paths are stored relative to it
+        self.parent = Path(parent)
+        # indexing & cleanup of a repository may run on different threads
+        self.db = sqlite3.connect(str(path), check_same_thread = False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+    def close(self):
+        self.db.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def relative(self, path):
+        return Path(path).relative_to(self.parent).as_posix()
+    def reconciled(self):
+        # time of the last full scan; the journal is incomplete before one
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'reconciled'").fetchone()
+        return None if row is None else float(row[0])
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+    def recordIndex(self, index):
+        '''Records the files of index found in the tree, forgets the others
+        (failed downloads); returns the number recorded'''
+        now = int(time.time())
+        recorded = []
+        missing = []
+        for entry, path in indexFiles(index, self.parent):
+            try:
+                st = path.stat()
+            except OSError:
+                missing.append((self.relative(path),))
+                continue
+            sha256 = entry.get('sha256')
+            if entry.get('file', '') != '%d' % st.st_size:
+                sha256 = None
+            recorded.append((self.relative(path), st.st_size, st.st_mtime_ns, sha256, now))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', recorded)
+            self.db.executemany('DELETE FROM files WHERE path = ?', missing)
+        return len(recorded)
+    def forgetIndex(self, index):
+        if index is None:
+            return
+        with self.db:
+            self.db.executemany('DELETE FROM files WHERE path = ?', [(self.relative(path),) for entry, path in indexFiles(index, self.parent)])
+    def reconcile(self, tree, url):
+        '''Replaces the journal with a scan of the tree (pathtools.directoryIndex
+        with this url); records whose size did not change keep mtime & hash'''
+        known = {}
+        for path, size, mtime, sha256 in self.db.execute('SELECT path, size, mtime, sha256 FROM files'):
+            known[path] = (size, mtime, sha256)
+        now = int(time.time())
+        rows = []
+        for entry, path in indexFiles(tree, self.parent):
+            relpath = entry['url'].removeprefix(url)
+            size = int(entry['file'])
+            previous = known.get(relpath)
+            if previous is not None and previous[0] == size:
+                rows.append((relpath, size, previous[1], previous[2], now))
+            else:
+                rows.append((relpath, size, None, None, now))
+        with self.db:
+            self.db.execute('DELETE FROM files')
+            self.db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)', rows)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('reconciled', ?)", ('%f' % time.time(),))
+        return len(rows)
+    def missingIndex(self, index, exclude = None):
+        '''Index of the files of index not recorded (deleted by hand, lost
+        downloads), leaving out those of exclude already to be fetched'''
+        known = set(path for (path,) in self.db.execute('SELECT path FROM files'))
+        if exclude is not None:
+            known.update(self.relative(path) for entry, path in indexFiles(exclude, self.parent))
+        return buildIndex((relpath, entry) for relpath, entry in
+                ((self.relative(path), entry) for entry, path in indexFiles(index, self.parent)) if relpath not in known)
+    def pathIndex(self, url):
+        # same shape as pathtools.directoryIndex, from the records
+        return buildIndex((path, { 'file' : '%d' % size, 'url' : url + path })
+                for path, size in self.db.execute('SELECT path, size FROM files ORDER BY path'))
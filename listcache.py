@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+'''
+Persistent directory listing cache for conditional GETs (ETag / Last-Modified)
+'''
+
+# python 3.9 and onward required
+
+import os
+import json
+from pathlib import Path
+
+class ListingCache:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.listings = {}
+        self.seen = set()
+        self.hits = 0
+        if self.path.is_file():
+            try:
+                with self.path.open('r', encoding='utf-8') as f:
+                    self.listings = json.load(f)
+            except Exception as e:
+                print('Cannot read listing cache, starting empty: %s' % str(e))
+                self.listings = {}
+    def validators(self, url):
+        headers = {}
+        if url in self.listings:
+            listing = self.listings[url]
+            if listing.get('etag'):
+                headers['If-None-Match'] = listing['etag']
+            if listing.get('last_modified'):
+                headers['If-Modified-Since'] = listing['last_modified']
+        return headers
+    def get(self, url):
+        if url in self.listings:
+            return self.listings[url]['entries']
+        return None
+    def update(self, url, meta, entries):
+        if meta.get('etag') or meta.get('last_modified'):
+            self.listings[url] = {
+                'etag' : meta.get('etag'),
+                'last_modified' : meta.get('last_modified'),
+                'entries' : entries
+            }
+        elif url in self.listings:
+            # server stopped sending validators
+            del self.listings[url]
+    def resolve(self, url, status, entries, meta):
+        # returns the entries to use for a fetched listing
+        # (status 0: listing failed, keep the previous one if known)
+        self.seen.add(url)
+        if status == 304 or status == 0:
+            cached = self.get(url)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            return []
+        if status == 200:
+            self.update(url, meta, entries)
+        return entries
+    def save(self):
+        # forget directories which were not visited in this crawl
+        for url in list(self.listings.keys()):
+            if url not in self.seen:
+                del self.listings[url]
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w', encoding='utf-8') as f:
+            json.dump(self.listings, f)
+        os.replace(str(tmp), str(self.path))
@@ -127,6 +127,18 @@ class generalOptions(Options):
     cache = OptionItem(var_type=Path, default=def_general.cache)
     whitelist = OptionItem(var_type=list, default=def_general.whitelist)
     blacklist = OptionItem(var_type=list, default=def_general.blacklist)
+    crawler = OptionItem(default=def_general.crawler)
+    connections = OptionItem(var_type=int, default=def_general.connections)
+    indexer = OptionItem(default=def_general.indexer)
+    listing_cache = OptionItem(var_type=bool, default=def_general.listing_cache)
+    incremental = OptionItem(var_type=bool, default=def_general.incremental)
+    verify = OptionItem(default=def_general.verify)
+    index_format = OptionItem(default=def_general.index_format)
+    diff_memory = OptionItem(var_type=int, default=def_general.diff_memory)
+    pipeline = OptionItem(var_type=bool, default=def_general.pipeline)
+    downloader = OptionItem(default=def_general.downloader)
+    store = OptionItem(default=def_general.store)
+    journal = OptionItem(var_type=bool, default=def_general.journal)
     def prepare_variables(self):
         src = self.source
         d = self.distro
@@ -134,13 +146,45 @@ class generalOptions(Options):
         c = self.cache
         w = self.whitelist
         b = self.blacklist
+        cr = self.crawler
+        cn = self.connections
+        ix = self.indexer
+        lc = self.listing_cache
+        ic = self.incremental
+        v = self.verify
+        fm = self.index_format
+        dm = self.diff_memory
+        pl = self.pipeline
+        dl = self.downloader
+        st = self.store
+        jn = self.journal
 
 class aria2Options(Options):
     detach = OptionItem(var_type=bool, default=def_aria2.detach)
     listen_all = OptionItem(var_type=bool, default=def_aria2.listen_all)
     port = OptionItem(var_type=int, default=def_aria2.port)
     secret = OptionItem(default=def_aria2.secret)
+    batch_size = OptionItem(var_type=int, default=def_aria2.batch_size)
     def prepare_variables(self):
         l = self.listen_all
         p = self.port
         s = self.secret
+        bs = self.batch_size
+
+# keys a [repository <name>] section may set for itself
+REPOSITORY_KEYS = ['source', 'distro', 'destination', 'whitelist', 'blacklist', 'indexer', 'incremental', 'verify', 'store']
+
+def repositoryOptions(options):
+    """(name, generalOptions) of every [repository <name>] section; keys
+    missing from a section are taken from [general]"""
+    repositories = []
+    for section in options.__parent__.sections():
+        if not section.startswith('repository '):
+            continue
+        parser = configparser.ConfigParser()
+        parser.read_dict({ 'general' : dict(options.__section__.items()) })
+        for key, value in options.__parent__[section].items():
+            if key in REPOSITORY_KEYS:
+                parser['general'][key] = value
+        repositories.append((section.removeprefix('repository ').strip(), generalOptions(parser)))
+    return repositories
@@ -10,15 +10,21 @@ import subprocess
 from time import sleep
 from pathlib import Path
 import aria2p
-from pathtools import saveIndex, fileCleanup
+from concurrent.futures import ThreadPoolExecutor
+from pathtools import saveIndex, loadIndex, fileCleanup, indexPath, cachePath
 from defaults import def_general, def_aria2
 from argparser import ConsoleArguments
-from loadconfig import generalOptions, aria2Options
-from analyse import indexURL_Threaded
-from difftree import diffIndices_Threaded
-from fetch import indexDownload, waitForAllFetches
+from loadconfig import generalOptions, aria2Options, repositoryOptions
+from asynccrawl import SharedCrawler
+from downloader import Aria2Downloader
+from asyncfetch import AsyncDownloader
+from repository import RepositorySync, FETCH_STAGES
+from journal import StateJournal
+from indexstream import isStreamIndex, iterIndexFile, zstandard
+from packedindex import PackedIndex
 from dicttools import listStat, transverseDict, filesTree
 from treeclean import treeCleanup, pathTrim
+from metrics import registry
 
 def updateOptions(generalOpts, aria2Opts, inArgs):
     if inArgs.source != def_general.source:
@@ -33,6 +39,30 @@ def updateOptions(generalOpts, aria2Opts, inArgs):
         generalOpts.whitelist = inArgs.include
     if inArgs.exclude != def_general.blacklist:
         generalOpts.blacklist = inArgs.exclude
+    if inArgs.crawler != def_general.crawler:
+        generalOpts.crawler = inArgs.crawler
+    if inArgs.connections != def_general.connections:
+        generalOpts.connections = inArgs.connections
+    if inArgs.indexer != def_general.indexer:
+        generalOpts.indexer = inArgs.indexer
+    if inArgs.verify != def_general.verify:
+        generalOpts.verify = inArgs.verify
+    if inArgs.index_format != def_general.index_format:
+        generalOpts.index_format = inArgs.index_format
+    if inArgs.diff_memory != def_general.diff_memory:
+        generalOpts.diff_memory = inArgs.diff_memory
+    if inArgs.pipeline != def_general.pipeline:
+        generalOpts.pipeline = inArgs.pipeline
+    if inArgs.downloader != def_general.downloader:
+        generalOpts.downloader = inArgs.downloader
+    if inArgs.store != def_general.store:
+        generalOpts.store = inArgs.store
+    if inArgs.journal != def_general.journal:
+        generalOpts.journal = inArgs.journal
+    if inArgs.listing_cache != def_general.listing_cache:
+        generalOpts.listing_cache = inArgs.listing_cache
+    if inArgs.incremental != def_general.incremental:
+        generalOpts.incremental = inArgs.incremental
     if inArgs.detach_aria2 != def_aria2.detach:
         aria2Opts.detach = inArgs.detach_aria2
     if inArgs.rpc_listen_all != def_aria2.listen_all:
@@ -41,6 +71,8 @@ def updateOptions(generalOpts, aria2Opts, inArgs):
         aria2Opts.port = inArgs.rpc_port
     if inArgs.rpc_secret != def_aria2.secret:
         aria2Opts.secret = inArgs.rpc_secret
+    if inArgs.rpc_batch_size != def_aria2.batch_size:
+        aria2Opts.batch_size = inArgs.rpc_batch_size
 
 def tryCreateDirs(path):
     p = Path(path)
@@ -67,30 +99,68 @@ def permissionCheck(path):
         sys.exit(1)
 
 def doPathTrim(generalOpts, inArgs):
-    srcname = str(generalOpts.source)
-    if srcname.find('https') == 0:
-        srcname = srcname.removeprefix('https://')
-    else:
-        srcname = srcname.removeprefix('http://')
-    if srcname.endswith('/'):
-        srcname = srcname.removesuffix('/')
-    if srcname.find('/') >= 0:
-        srcsplit = srcname.split('/')
-        srcname = '_'.join(srcsplit)
-    p = generalOpts.cache / str(srcname + '_' + generalOpts.distro + '_index.json')
+    p = indexPath(generalOpts.cache, generalOpts.source, generalOpts.distro, generalOpts.index_format)[1]
     if p.is_file():
         idx = None
         try:
-            with p.open('r') as f:
-                idx = json.load(f)
+            # streamed & packed indices are read as the trim goes
+            if isStreamIndex(p):
+                idx = iterIndexFile(p)
+            elif p.suffix == '.hsix':
+                idx = PackedIndex(p)
+            else:
+                idx = loadIndex(p)
         except Exception as e:
             print('Cannot read current index: %s' % str(e))
             sys.exit(1)
-        pathTrim(generalOpts.destination, generalOpts.distro, generalOpts.source, idx, save_path=generalOpts.cache, dry_run=inArgs.trim_dryrun, use_cached=inArgs.trim_use_scanned)
-        sys.exit(0)
+        journal = None
+        if generalOpts.journal:
+            journal = StateJournal(cachePath(generalOpts.cache, generalOpts.source, generalOpts.distro, 'state.sqlite'), generalOpts.destination / generalOpts.distro)
+        pathTrim(generalOpts.destination, generalOpts.distro, generalOpts.source, idx, save_path=generalOpts.cache, dry_run=inArgs.trim_dryrun, use_cached=inArgs.trim_use_scanned, journal=journal, reconcile=inArgs.reconcile)
+        if journal is not None:
+            journal.close()
+        if isinstance(idx, PackedIndex):
+            idx.close()
+        return True
     else:
         print('FAIL: Missing index or not mirrored')
+        return False
+
+def connectAria2(aria2Opts):
+    # aria2 instance start
+    if not aria2Opts.detach:
+        print('Creating aria2 instance')
+        # allow using existing aria2 instance rather than spawning one (issue #1)
+        aria2Args = ['aria2c', '--daemon', '--stop-with-process=%d' % os.getpid(), '--enable-rpc', '--rpc-listen-port=%s' % str(aria2Opts.port)]
+        if aria2Opts.listen_all:
+            aria2Args.append('--rpc-listen-all')
+        if len(aria2Opts.secret) > 7:
+            aria2Args.append('--rpc-secret="%s"' % aria2Opts.secret)
+        aria2Proc = subprocess.run(aria2Args)
+        sleep(1)
+    print('Connecting to aria2 instance')
+    aria2 = aria2p.API(aria2p.Client(
+            host   = 'http://127.0.0.1',
+            port   = aria2Opts.port,
+            secret = aria2Opts.secret
+        ))
+    try:
+        stat = aria2.get_stats()
+    except:
+        print('ERROR: aria2 RPC is not running or inaccessible.\n')
         sys.exit(1)
+    return aria2
+
+def createDownloader(generalOpts, aria2Opts):
+    if generalOpts.downloader == 'native':
+        return AsyncDownloader(generalOpts.connections).start()
+    # aria2 follows completions through its notifications
+    return Aria2Downloader(connectAria2(aria2Opts), aria2Opts.batch_size).start()
+
+def finish(generalOpts, success):
+    # run metrics for cron monitoring: cache directory, textfile & JSON
+    registry.finish(generalOpts.cache, success)
+    sys.exit(0 if success else 1)
 
 def main():
     # system check
@@ -116,135 +186,79 @@ def main():
     if Args.save and Args.config is not None:
         gOpts.flush(True)
         aOpts.flush(True)
-    # requirement check: source specified
-    if gOpts.source is None or gOpts.source == '':
-        Args.parser.print_help()
-        print("\nERROR: Repository source unspecified.\n")
-        sys.exit(1)
-    # permission check & build paths
-    if gOpts.destination.is_dir():
-        permissionCheck(gOpts.destination)
-    else:
-        tryCreateDirs(gOpts.destination)
-    if gOpts.cache.is_dir():
-        permissionCheck(gOpts.cache)
-    else:
-        tryCreateDirs(gOpts.cache)
+    # one [repository <name>] section per repository, or [general] alone
+    repositories = repositoryOptions(gOpts)
+    if len(repositories) == 0:
+        repositories = [('', gOpts)]
+    for name, opts in repositories:
+        # requirement check: source specified
+        if opts.source is None or opts.source == '':
+            Args.parser.print_help()
+            print("\nERROR: Repository source unspecified.\n")
+            sys.exit(1)
+        if opts.index_format == 'ndjson.zst' and zstandard is None:
+            print('\nERROR: Index format "ndjson.zst" needs "zstandard" (pip install zstandard).\n')
+            sys.exit(1)
+        # permission check & build paths
+        if opts.destination.is_dir():
+            permissionCheck(opts.destination)
+        else:
+            tryCreateDirs(opts.destination)
+        if opts.cache.is_dir():
+            permissionCheck(opts.cache)
+        else:
+            tryCreateDirs(opts.cache)
     # do path trim if called
     if Args.destination_trim:
-        doPathTrim(gOpts, Args)
-        sys.exit(1)
-    # aria2 instance start
-    if not aOpts.detach:
-        print('Creating aria2 instance')
-        # allow using existing aria2 instance rather than spawning one (issue #1)
-        aria2Args = ['aria2c', '--daemon', '--stop-with-process=%d' % os.getpid(), '--enable-rpc', '--rpc-listen-port=%s' % str(aOpts.port)]
-        if aOpts.listen_all:
-            aria2Args.append('--rpc-listen-all')
-        if len(aOpts.secret) > 7:
-            aria2Args.append('--rpc-secret="%s"' % aOpts.secret)
-        aria2Proc = subprocess.run(aria2Args)
-        sleep(1)
-    print('Connecting to aria2 instance')
-    aria2 = aria2p.API(aria2p.Client(
-            host   = 'http://127.0.0.1',
-            port   = aOpts.port,
-            secret = aOpts.secret
-        ))
-    try:
-        stat = aria2.get_stats()
-    except:
-        print('ERROR: aria2 RPC is not running or inaccessible.\n')
-        sys.exit(1)
-    # build index
-    print('Building index from source')
-    url = gOpts.source
-    if not url.endswith('/'):
-        url += '/'
-    url += gOpts.distro
-    newIndex = indexURL_Threaded(url, gOpts.whitelist, gOpts.blacklist, 16)
-    # check existing index
-    srcname = str(gOpts.source)
-    if srcname.find('https') == 0:
-        srcname = srcname.removeprefix('https://')
-    else:
-        srcname = srcname.removeprefix('http://')
-    if srcname.endswith('/'):
-        srcname = srcname.removesuffix('/')
-    if srcname.find('/') >= 0:
-        srcsplit = srcname.split('/')
-        srcname = '_'.join(srcsplit)
-    currIndexPath = gOpts.cache / str(srcname + '_' + gOpts.distro + '_index.json')
-    currIndex = None
-    newFiles = {}
-    oldFiles = None
-    addedFiles = None
-    deletedFiles = None
-    updatedFiles = None
-    if currIndexPath.is_file():
-        print('Current index is found')
-        try:
-            with currIndexPath.open('r') as f:
-                currIndex = json.load(f)
-        except Exception as e:
-            print('Failed reading current index: %s' % str(e))
-    # - build diff index (add & remove)
-    if currIndex is None:
-        newFiles = newIndex
-        addedFiles = newIndex
-    else:
-        print('Comparing for changes')
-        newFiles = diffIndices_Threaded(currIndex, newIndex, maxThreads = 64)
-        oldFiles = diffIndices_Threaded(newIndex, currIndex, maxThreads = 64)
-        # - categorise files update/add/delete
-        addedFiles   = diffIndices_Threaded(oldFiles, newFiles, True, 64)
-        deletedFiles = diffIndices_Threaded(newFiles, oldFiles, True, 64)
-        updatedFiles = diffIndices_Threaded(addedFiles, newFiles, True, 64)
-    # save new index
-    saveIndex(newIndex, currIndexPath)
-    # statistics
-    print('Summary:')
-    print(' - New files: %d' % listStat(newFiles))
-    if oldFiles is not None:
-        print(' - Old files: %d' % listStat(oldFiles))
-    print(' - Files to be added: %d' % listStat(addedFiles))
-    if deletedFiles is not None:
-        print(' - Files to be deleted: %d' % listStat(deletedFiles))
-    if updatedFiles is not None:
-        print(' - Files to be updated: %d' % listStat(updatedFiles))
-    # fetch new files
-    # - fetch pool
-    if 'pool' in newFiles:
-        print('Downloading "pool"')
-        print('Added %d files to downloads' % len(indexDownload(aria2, newFiles['pool'], gOpts.destination / gOpts.distro / 'pool')))
-        waitForAllFetches(aria2)
-        print('Downloaded "pool"')
-    # - fetch dists
-    if 'dists' in newFiles:
-        print('Downloading "dists"')
-        print('Added %d files to downloads' % len(indexDownload(aria2, newFiles['dists'], gOpts.destination / gOpts.distro / 'dists')))
-        waitForAllFetches(aria2)
-        print('Downloaded "dists"')
-    # - fetch remaining
-    print('Downloading other files')
-    fetch_count = 0
-    for key in newFiles.keys():
-        if key == 'pool' or key == 'dists':
-            continue
-        elif key == 'files':
-            directory = { key : newFiles[key] }
-            fetch_count += len(indexDownload(aria2, directory, gOpts.destination / gOpts.distro))
-        else:
-            fetch_count += len(indexDownload(aria2, newFiles[key], gOpts.destination / gOpts.distro))
-    print('Added %d files to downloads' % fetch_count)
-    waitForAllFetches(aria2)
-    # remove old files
-    treeCleanup(deletedFiles, Path(gOpts.destination) / gOpts.distro)
-    # triming excesses
-    pathTrim(gOpts.destination, gOpts.distro, gOpts.source, newIndex, gOpts.cache, Args.trim_dryrun)
+        trimmed = [doPathTrim(opts, Args) for name, opts in repositories]
+        sys.exit(0 if all(trimmed) else 1)
+    # downloader & crawler shared by every repository
+    downloader = createDownloader(gOpts, aOpts)
+    crawler = None
+    if gOpts.crawler == 'async':
+        crawler = SharedCrawler(gOpts.connections).start()
+    repos = [RepositorySync(opts, downloader, aOpts.batch_size, crawler, name) for name, opts in repositories]
+    # build indices concurrently through the shared crawler; crawl processes
+    # bring their own connections, one repository at a time
+    indexed = []
+    with ThreadPoolExecutor(max_workers = len(repos) if crawler is not None else 1) as executor:
+        futures = [executor.submit(repo.index) for repo in repos]
+        for repo, future in zip(repos, futures):
+            try:
+                future.result()
+                indexed.append(repo)
+            except Exception as e:
+                repo.log('Failed building index: %s' % str(e))
+    if crawler is not None:
+        crawler.stop()
+    if len(indexed) == 0:
+        downloader.stop()
+        finish(gOpts, False)
+    # fetch new files, one stage of every repository at a time
+    with registry.timer('stage_duration_seconds', stage = 'download'):
+        for stage in FETCH_STAGES:
+            if not any(len(repo.stage(stage)) > 0 for repo in indexed):
+                continue
+            label = '"%s"' % stage if stage != '' else 'other files'
+            print('Downloading %s' % label)
+            print('Added %d files to downloads' % sum(repo.queueStage(stage) for repo in indexed))
+            downloader.wait()
+            print('Downloaded %s' % label)
+        # pipelined downloads
+        downloader.wait()
+    # verify checksums
+    if sum(repo.verify() for repo in indexed) > 0:
+        downloader.wait()
+    downloader.stop()
+    # remove old files & trim excesses
+    for repo in indexed:
+        repo.cleanup(Args.trim_dryrun, Args.reconcile)
     # return
+    if len(indexed) < len(repos):
+        print('Mirror incomplete: %d of %d repositories failed\n' % (len(repos) - len(indexed), len(repos)))
+        finish(gOpts, False)
     print('Mirror complete!\n')
-    sys.exit(0)
+    finish(gOpts, True)
 
 if __name__ == '__main__':
     main()
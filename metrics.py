@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+'''
+Run metrics: timers & counters gathered during a sync, written to the cache
+directory as a Prometheus textfile (node_exporter textfile collector) and
+a JSON summary of the run
+'''
+
+# python 3.9 and onward required
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+PREFIX = 'httpsync_'
+TEXTFILE = 'httpsync.prom'
+SUMMARY = 'last-run.json'
+
+# name : (type, help); a summary is exported as <name>_sum & <name>_count.
+# Every value covers the last run only, counts are gauges for that reason
+DESCRIPTIONS = {
+    'stage_duration_seconds' : ('summary', 'Time spent in a sync stage'),
+    'parse_duration_seconds' : ('summary', 'Time spent parsing directory listings'),
+    'download_wait_seconds' : ('summary', 'Time spent waiting for queued downloads'),
+    'cleanup_duration_seconds' : ('summary', 'Time spent deleting files'),
+    'listing_requests' : ('gauge', 'Directory listings requested, by result'),
+    'listing_retries' : ('gauge', 'Directory listing requests retried'),
+    'download_requests' : ('gauge', 'Downloads queued, retried and given up'),
+    'index_files' : ('gauge', 'Files in the new index'),
+    'changed_files' : ('gauge', 'Files found added, deleted, updated or missing'),
+    'synced_files' : ('gauge', 'New and updated files present after the downloads'),
+    'synced_bytes' : ('gauge', 'Bytes of the new and updated files present after the downloads'),
+    'deleted_files' : ('gauge', 'Files deleted'),
+    'deleted_bytes' : ('gauge', 'Bytes of the files deleted'),
+    'deleted_directories' : ('gauge', 'Empty directories pruned'),
+    'run_duration_seconds' : ('gauge', 'Duration of the run'),
+    'run_success' : ('gauge', 'Whether the run mirrored every repository'),
+    'last_run_timestamp_seconds' : ('gauge', 'End of the last run'),
+    'last_success_timestamp_seconds' : ('gauge', 'End of the last successful run')
+}
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def seriesName(name, labels):
+    if len(labels) == 0:
+        return PREFIX + name
+    return '%s%s{%s}' % (PREFIX, name, ','.join('%s="%s"' % (key, escapeLabel(value)) for key, value in labels))
+
+def writeAtomic(path, text):
+    # readers (node_exporter) never see a partial file
+    tmp = path.with_name(path.name + '.tmp')
+    with tmp.open('w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(str(tmp), str(path))
+
+class Metrics:
+    '''Thread-safe registry; labels are keyword arguments'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.started = time.time()
+    def key(self, name, labels):
+        if name not in DESCRIPTIONS:
+            raise KeyError('Unknown metric: %s' % name)
+        return (name, tuple(sorted(labels.items())))
+    def count(self, name, value = 1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+    def set(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = value
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            total, calls = self.values.get(key, (0.0, 0))
+            self.values[key] = (total + seconds, calls + 1)
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+    def get(self, name, **labels):
+        with self.lock:
+            return self.values.get(self.key(name, labels))
+    def series(self, only = None):
+        # (series name, value) in export order
+        with self.lock:
+            items = sorted(self.values.items())
+        series = []
+        for (name, labels), value in items:
+            if only is not None and name != only:
+                continue
+            if DESCRIPTIONS[name][0] == 'summary':
+                series.append((seriesName(name + '_sum', labels), value[0]))
+                series.append((seriesName(name + '_count', labels), value[1]))
+            else:
+                series.append((seriesName(name, labels), value))
+        return series
+    def textfile(self):
+        lines = []
+        with self.lock:
+            names = sorted(set(name for name, labels in self.values.keys()))
+        for name in names:
+            kind, text = DESCRIPTIONS[name]
+            lines.append('# HELP %s%s %s' % (PREFIX, name, text))
+            lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+            for series, value in self.series(name):
+                lines.append('%s %s' % (series, repr(value) if type(value) is float else value))
+        return '\n'.join(lines) + '\n'
+    def finish(self, cache, success):
+        '''Sets the run gauges and writes the textfile & JSON summary to the
+        cache directory; the last success is carried over from the
+        previous summary when this run failed'''
+        cache = Path(cache)
+        finished = time.time()
+        lastSuccess = finished if success else None
+        if not success:
+            try:
+                with (cache / SUMMARY).open('r', encoding='utf-8') as f:
+                    lastSuccess = json.load(f).get('last_success')
+            except Exception:
+                pass
+        self.set('run_duration_seconds', finished - self.started)
+        self.set('run_success', 1 if success else 0)
+        self.set('last_run_timestamp_seconds', int(finished))
+        if lastSuccess is not None:
+            self.set('last_success_timestamp_seconds', int(lastSuccess))
+        summary = {
+            'started' : self.started,
+            'finished' : finished,
+            'success' : success,
+            'last_success' : lastSuccess,
+            'metrics' : dict(self.series())
+        }
+        try:
+            writeAtomic(cache / TEXTFILE, self.textfile())
+            writeAtomic(cache / SUMMARY, json.dumps(summary, indent = 1) + '\n')
+        except OSError as e:
+            print('Cannot write run metrics: %s' % str(e))
+
+# registry of the running sync
+registry = Metrics()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+'''
+Compact, memory-mappable index format (".hsix")
+
+Layout (little-endian):
+ - header: magic, version, flags, entry count, restart interval, section offsets
+ - paths: sorted relative paths, front-coded (varint shared length, varint
+   suffix length, suffix) with a full path every <restart interval> entries
+ - restarts: uint64 offset of every restart path
+ - sizes: int64 per entry, exact bytes or -(string + 1) for sizes like "1.2M"
+ - stamps: int64 per entry, UTC epoch seconds of "%Y-%m-%d %H:%M",
+   STAMP_MISSING / STAMP_EMPTY or -(string + 3)
+ - hashes: 32 bytes of SHA256 per entry, zeroes when unknown (optional)
+ - strings: count, uint64 offsets, UTF-8 data; string 0 is the base URL
+
+Usage: python3 packedindex.py pack|unpack <input> <output>
+'''
+
+# python 3.9 and onward required
+
+import re
+import sys
+import json
+import mmap
+import struct
+import bisect
+import calendar
+import datetime
+from pathlib import Path
+
+MAGIC = b'HSIX'
+VERSION = 1
+FLAG_HASHES = 1
+HEADER = struct.Struct('<4sHHQII6Q')
+INT64 = struct.Struct('<q')
+UINT64 = struct.Struct('<Q')
+RESTART_INTERVAL = 16
+STAMP_MISSING = -1
+STAMP_EMPTY = -2
+STAMP_FORMAT = re.compile(r'^(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2})$')
+NO_HASH = bytes(32)
+
+def encodeVarint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+def decodeVarint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def commonPrefix(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+def encodeStamp(stamp):
+    m = STAMP_FORMAT.match(stamp)
+    if m is None:
+        return None
+    try:
+        return calendar.timegm((int(m.group(1)), int(m.group(2)), int(m.group(3)), int(m.group(4)), int(m.group(5)), 0))
+    except ValueError:
+        return None
+
+def encodeSize(size):
+    # exact bytes, None for listing sizes ("1.2M") and for digit strings
+    # which would not read back the same ("007", "²")
+    if size.isdigit() and size.isascii() and (size == '0' or not size.startswith('0')) and int(size) < (1 << 63):
+        return int(size)
+    return None
+
+def decodeStamp(value):
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M')
+
+def align8(buf):
+    while len(buf) % 8 != 0:
+        buf.append(0)
+
+# (relative path, entry) of a nested index, sorted by path
+def iterIndex(index, prefix = ''):
+    items = []
+    for key in index.keys():
+        if key == 'files':
+            for entry in index[key]:
+                items.append((prefix + entry['url'].rsplit('/', 1)[1], None, entry))
+        else:
+            items.append((prefix + key + '/', key, None))
+    items.sort(key = lambda item: item[0])
+    for path, key, entry in items:
+        if key is None:
+            yield path, entry
+        else:
+            yield from iterIndex(index[key], path)
+
+# nested index from (relative path, entry) pairs
+def buildIndex(items):
+    index = {}
+    for path, entry in items:
+        vect = index
+        keys = path.split('/')
+        for key in keys[:-1]:
+            if key not in vect:
+                vect[key] = {}
+            vect = vect[key]
+        if 'files' not in vect:
+            vect['files'] = []
+        vect['files'].append(entry)
+    return index
+
+def packItems(items, path, base):
+    '''Writes sorted (relative path, entry) pairs; entry URLs must be base + path'''
+    strings = [base]
+    stringIds = { base : 0 }
+    def stringId(value):
+        if value not in stringIds:
+            stringIds[value] = len(strings)
+            strings.append(value)
+        return stringIds[value]
+    paths = bytearray()
+    restarts = []
+    sizes = bytearray()
+    stamps = bytearray()
+    hashes = bytearray()
+    hasHashes = False
+    previous = b''
+    count = 0
+    for relpath, entry in items:
+        if entry['url'] != base + relpath:
+            raise ValueError('Entry URL does not match its index position: %s' % entry['url'])
+        encoded = relpath.encode('utf-8')
+        if encoded <= previous and count > 0:
+            raise ValueError('Index paths are not sorted: %s' % relpath)
+        if count % RESTART_INTERVAL == 0:
+            restarts.append(len(paths))
+            shared = 0
+        else:
+            shared = commonPrefix(previous, encoded)
+        paths += encodeVarint(shared)
+        paths += encodeVarint(len(encoded) - shared)
+        paths += encoded[shared:]
+        previous = encoded
+        # size
+        size = entry.get('file', '')
+        value = encodeSize(size)
+        if value is not None:
+            sizes += INT64.pack(value)
+        else:
+            sizes += INT64.pack(-(stringId(size) + 1))
+        # timestamp
+        if 'timestamp' not in entry:
+            stamp = STAMP_MISSING
+        elif entry['timestamp'] == '':
+            stamp = STAMP_EMPTY
+        else:
+            stamp = encodeStamp(entry['timestamp'])
+            if stamp is None or decodeStamp(stamp) != entry['timestamp']:
+                stamp = -(stringId(entry['timestamp']) + 3)
+        stamps += INT64.pack(stamp)
+        # hash
+        if 'sha256' in entry:
+            hasHashes = True
+            hashes += bytes.fromhex(entry['sha256'])
+        else:
+            hashes += NO_HASH
+        count += 1
+    # assemble sections
+    out = bytearray(HEADER.size)
+    align8(paths)
+    pathsOffset = len(out)
+    out += paths
+    restartsOffset = len(out)
+    for offset in restarts:
+        out += UINT64.pack(offset)
+    sizesOffset = len(out)
+    out += sizes
+    stampsOffset = len(out)
+    out += stamps
+    hashesOffset = 0
+    if hasHashes:
+        hashesOffset = len(out)
+        out += hashes
+    stringsOffset = len(out)
+    encodedStrings = [value.encode('utf-8') for value in strings]
+    out += UINT64.pack(len(encodedStrings))
+    position = 0
+    for value in encodedStrings:
+        out += UINT64.pack(position)
+        position += len(value)
+    out += UINT64.pack(position)
+    for value in encodedStrings:
+        out += value
+    HEADER.pack_into(out, 0, MAGIC, VERSION, FLAG_HASHES if hasHashes else 0, count, RESTART_INTERVAL, 0,
+            pathsOffset, restartsOffset, sizesOffset, stampsOffset, hashesOffset, stringsOffset)
+    p = Path(path)
+    tmp = p.with_name(p.name + '.tmp')
+    with tmp.open('wb') as f:
+        f.write(out)
+    tmp.replace(p)
+    return count
+
+def indexBase(index):
+    for relpath, entry in iterIndex(index):
+        return entry['url'][:len(entry['url']) - len(relpath)]
+    return ''
+
+def packIndex(index, path, base = None):
+    if base is None:
+        base = indexBase(index)
+    return packItems(iterIndex(index), path, base)
+
+class PackedIndex:
+    '''Read-only view of a packed index file through mmap'''
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        (magic, version, self.flags, self.count, self.interval, _pad,
+            self.pathsOffset, self.restartsOffset, self.sizesOffset, self.stampsOffset,
+            self.hashesOffset, self.stringsOffset) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('Not a packed index: %s' % str(path))
+        self.stringCount = UINT64.unpack_from(self.map, self.stringsOffset)[0]
+        self.base = self.string(0)
+        self.blocks = (self.count + self.interval - 1) // self.interval
+        self.restartPaths = None
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def __len__(self):
+        return self.count
+    def string(self, i):
+        offsets = self.stringsOffset + 8
+        start = UINT64.unpack_from(self.map, offsets + 8 * i)[0]
+        end = UINT64.unpack_from(self.map, offsets + 8 * (i + 1))[0]
+        data = self.stringsOffset + 8 + 8 * (self.stringCount + 1)
+        return self.map[data + start:data + end].decode('utf-8')
+    def restart(self, block):
+        return self.pathsOffset + UINT64.unpack_from(self.map, self.restartsOffset + 8 * block)[0]
+    def iterPaths(self, start = 0):
+        # decodes paths from the restart block holding entry "start"
+        block = start // self.interval
+        i = block * self.interval
+        pos = self.restart(block) if self.count > 0 else 0
+        previous = b''
+        while i < self.count:
+            shared, pos = decodeVarint(self.map, pos)
+            length, pos = decodeVarint(self.map, pos)
+            current = previous[:shared] + self.map[pos:pos + length]
+            pos += length
+            previous = current
+            if i >= start:
+                yield i, current.decode('utf-8')
+            i += 1
+    def path(self, i):
+        for j, path in self.iterPaths(i):
+            return path
+        raise IndexError(i)
+    def size(self, i):
+        value = INT64.unpack_from(self.map, self.sizesOffset + 8 * i)[0]
+        return ('%d' % value) if value >= 0 else self.string(-value - 1)
+    def timestamp(self, i):
+        value = INT64.unpack_from(self.map, self.stampsOffset + 8 * i)[0]
+        if value >= 0:
+            return decodeStamp(value)
+        elif value == STAMP_MISSING:
+            return None
+        elif value == STAMP_EMPTY:
+            return ''
+        return self.string(-value - 3)
+    def sha256(self, i):
+        if not self.flags & FLAG_HASHES:
+            return None
+        digest = self.map[self.hashesOffset + 32 * i:self.hashesOffset + 32 * (i + 1)]
+        return None if digest == NO_HASH else digest.hex()
+    def entry(self, i, path = None):
+        if path is None:
+            path = self.path(i)
+        entry = { 'file' : self.size(i) }
+        timestamp = self.timestamp(i)
+        if timestamp is not None:
+            entry['timestamp'] = timestamp
+        entry['url'] = self.base + path
+        sha256 = self.sha256(i)
+        if sha256 is not None:
+            entry['sha256'] = sha256
+        return entry
+    def find(self, path):
+        # binary search over the restart paths, then scan one block
+        if self.restartPaths is None:
+            self.restartPaths = [self.blockPath(block) for block in range(self.blocks)]
+        block = bisect.bisect_right(self.restartPaths, path) - 1
+        if block < 0:
+            return None
+        for i, current in self.iterPaths(block * self.interval):
+            if current == path:
+                return i
+            if current > path or i >= (block + 1) * self.interval - 1:
+                return None
+        return None
+    def blockPath(self, block):
+        pos = self.restart(block)
+        shared, pos = decodeVarint(self.map, pos)
+        length, pos = decodeVarint(self.map, pos)
+        return self.map[pos:pos + length].decode('utf-8')
+    def get(self, path):
+        i = self.find(path)
+        return None if i is None else self.entry(i, path)
+    def __iter__(self):
+        # (relative path, entry) sorted by path, like iterIndex
+        for i, path in self.iterPaths():
+            yield path, self.entry(i, path)
+
+def unpackIndex(path):
+    with PackedIndex(path) as packed:
+        return buildIndex(iter(packed))
+
+def main():
+    if len(sys.argv) != 4 or sys.argv[1] not in ['pack', 'unpack']:
+        print('Usage: %s pack|unpack <input> <output>' % sys.argv[0])
+        sys.exit(1)
+    if sys.argv[1] == 'pack':
+        with open(sys.argv[2], 'r') as f:
+            index = json.load(f)
+        print('Packed %d entries' % packIndex(index, sys.argv[3]))
+    else:
+        index = unpackIndex(sys.argv[2])
+        with open(sys.argv[3], 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=4, sort_keys=True)
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
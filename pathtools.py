@@ -5,8 +5,12 @@ import os
 import json
 from time import sleep
 from pathlib import Path
+from urllib.parse import unquote
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dicttools import indepthDictUpdate
+from packedindex import packIndex, unpackIndex, iterIndex, indexBase, buildIndex
+from indexstream import isStreamIndex, writeIndexFile, iterIndexFile
 
 def changedir(curr, ext):
     c = Path(curr)
@@ -23,11 +27,78 @@ def changedir(curr, ext):
         return e
     return c / e
 
+# cache file name of a source & distro, e.g. "archive.raspberrypi.org_debian_index.json"
+def cachePath(cache, src_url, distro, suffix):
+    srcname = str(src_url)
+    if srcname.find('https') == 0:
+        srcname = srcname.removeprefix('https://')
+    else:
+        srcname = srcname.removeprefix('http://')
+    if srcname.endswith('/'):
+        srcname = srcname.removesuffix('/')
+    if srcname.find('/') >= 0:
+        srcsplit = srcname.split('/')
+        srcname = '_'.join(srcsplit)
+    return Path(cache) / str(srcname + '_' + distro + '_' + suffix)
+
+# index file of the configured format; falls back to an existing file of another format
+def indexPath(cache, src_url, distro, index_format = 'json'):
+    suffixes = {
+        'json' : 'index.json',
+        'packed' : 'index.hsix',
+        'ndjson' : 'index.ndjson',
+        'ndjson.gz' : 'index.ndjson.gz',
+        'ndjson.zst' : 'index.ndjson.zst'
+    }
+    p = cachePath(cache, src_url, distro, suffixes.get(index_format, 'index.json'))
+    if not p.is_file():
+        for suffix in suffixes.values():
+            other = cachePath(cache, src_url, distro, suffix)
+            if other.is_file():
+                return p, other
+    return p, p
+
 def saveIndex(index, path):
     p = Path(path)
+    if p.suffix == '.hsix':
+        packIndex(index, p)
+        return
+    if isStreamIndex(p):
+        writeIndexFile(iterIndex(index), p, indexBase(index))
+        return
     with p.open('w', encoding='utf-8') as f:
         json.dump(index, f, indent=4, sort_keys=True)
 
+def loadIndex(path):
+    p = Path(path)
+    if p.suffix == '.hsix':
+        return unpackIndex(p)
+    if isStreamIndex(p):
+        return buildIndex(iterIndexFile(p))
+    with p.open('r') as f:
+        return json.load(f)
+
+# (entry, destination path) of every file of an index
+def indexFiles(index, parent):
+    if 'files' in index:
+        for entry in index['files']:
+            yield entry, Path(parent) / unquote(entry['url'].rsplit('/', 1)[1])
+    for key in index.keys():
+        if key != 'files':
+            yield from indexFiles(index[key], Path(parent) / key)
+
+def presentFiles(index, parent):
+    # (number, bytes) of the files of index found under parent
+    count = 0
+    size = 0
+    for entry, path in indexFiles(index, parent):
+        try:
+            size += os.stat(str(path)).st_size
+            count += 1
+        except OSError:
+            pass
+    return (count, size)
+
 def updateIndex(index, path):
     with open(path, 'r') as f:
         index |= json.load(f)
@@ -53,7 +124,50 @@ def fileCleanup(path):
             except:
                 break
 
-def directoryIndex(parent, url):
+def removeFile(path):
+    # size of the removed file, None when it could not be removed
+    try:
+        size = os.lstat(path).st_size
+        os.remove(path)
+        return size
+    except OSError:
+        return None
+
+def filesCleanup(paths, root, maxThreads = 4):
+    '''Deletes paths (under root) in parallel, then prunes the directories
+    left empty, deepest first and each one once; returns (files, bytes,
+    directories) removed'''
+    root = Path(root)
+    files = 0
+    size = 0
+    with ThreadPoolExecutor(max_workers = maxThreads) as executor:
+        for removed in executor.map(removeFile, [str(p) for p in paths]):
+            if removed is not None:
+                files += 1
+                size += removed
+    parents = set()
+    for path in paths:
+        try:
+            parts = Path(path).relative_to(root).parts
+        except ValueError:
+            continue
+        for i in range(len(parts) - 1, 0, -1):
+            d = root.joinpath(*parts[:i])
+            if d in parents:
+                break
+            parents.add(d)
+    # a directory empties only once its subdirectories are gone: no listing
+    # needed, rmdir fails on the others
+    directories = 0
+    for d in sorted(parents, key = lambda d: len(d.parts), reverse = True):
+        try:
+            os.rmdir(str(d))
+            directories += 1
+        except OSError:
+            pass
+    return (files, size, directories)
+
+def directoryIndex_Walk(parent, url):
     p = Path(parent)
     if p.is_file():
         return { 'file' : '%d' % p.stat().st_size, 'url' : url }
@@ -77,3 +191,50 @@ def directoryIndex(parent, url):
         return tree
     else:
         return {}
+
+def scanDirectory(path, url, node):
+    # one directory level: its files go to node, its subdirectories are returned
+    subdirs = []
+    files = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        # like os.walk, links to directories are not followed
+                        if not entry.is_symlink():
+                            node[entry.name] = {}
+                            subdirs.append((entry.path, url + entry.name + '/', node[entry.name]))
+                    else:
+                        files.append({
+                            'file' : '%d' % entry.stat().st_size,
+                            'url' : url + entry.name
+                        })
+                except OSError:
+                    pass
+    except OSError:
+        return subdirs
+    node['files'] = files
+    return subdirs
+
+def directoryIndex(parent, url, maxThreads = 8):
+    '''Index of the files under parent (as directoryIndex_Walk); directories
+    are scanned by a thread pool so that their metadata I/O overlaps'''
+    p = Path(parent)
+    if p.is_file():
+        return { 'file' : '%d' % p.stat().st_size, 'url' : url }
+    elif p.is_dir():
+        tree = {}
+        c_url = str(url)
+        if not c_url.endswith('/'):
+            c_url += '/'
+        with ThreadPoolExecutor(max_workers = maxThreads) as executor:
+            pending = { executor.submit(scanDirectory, str(p), c_url, tree) }
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    for subdir in future.result():
+                        pending.add(executor.submit(scanDirectory, *subdir))
+        return tree
+    else:
+        return {}
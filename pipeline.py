@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+'''
+Pipelined crawl-to-download: every file reported by the crawler is compared
+with the previous index on the fly and changed ones are queued in the downloader
+while the crawl goes on; "dists" and deletions still wait for the full diff
+'''
+
+# python 3.9 and onward required
+
+import queue
+import asyncio
+import threading
+from pathlib import Path
+from urllib.parse import unquote
+from fetch import BATCH_SIZE
+from fileindex import Index
+
+# files waiting for submission; the crawler pauses beyond that
+QUEUE_SIZE = 10000
+# top directories left to the staged downloads after the crawl: no "dists"
+# may refer to packages not mirrored yet
+DEFERRED = ['dists']
+
+def entryChanged(old, new):
+    if old.get('timestamp') != new.get('timestamp'):
+        return True
+    if 'sha256' in old and 'sha256' in new:
+        return old['sha256'] != new['sha256']
+    # listing sizes ("1.2M") only compare with listing sizes, exact with exact
+    if old['file'].isdigit() == new['file'].isdigit():
+        return old['file'] != new['file']
+    return False
+
+class Gate:
+    '''Open / closed flag the crawlers wait on: threads with wait(), coroutines
+    with waitAsync() on their own loop, without holding an executor thread'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.event.set()
+        # (loop, future) of the coroutines waiting
+        self.waiters = []
+    def is_set(self):
+        return self.event.is_set()
+    def clear(self):
+        with self.lock:
+            self.event.clear()
+    def set(self):
+        with self.lock:
+            self.event.set()
+            waiters = self.waiters
+            self.waiters = []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda future = future: future.done() or future.set_result(None))
+    def wait(self):
+        self.event.wait()
+    async def waitAsync(self):
+        with self.lock:
+            if self.event.is_set():
+                return
+            future = asyncio.get_running_loop().create_future()
+            self.waiters.append((asyncio.get_running_loop(), future))
+        await future
+
+class DownloadPipeline:
+    '''Feed onFile() from the crawler (CrawlState onFile callback); previous
+    is an iterable of (relative path, entry) of the last index, if any;
+    files found in the content store are linked instead of downloaded'''
+    def __init__(self, downloader, base, parent, previous = None, batchSize = BATCH_SIZE, queueSize = QUEUE_SIZE, store = None):
+        self.downloader = downloader
+        self.store = store
+        self.base = base
+        self.parent = Path(parent)
+        self.batchSize = batchSize
+        self.previous = Index.fromItems(previous if previous is not None else [], base)
+        # onFile never blocks (it may run on the crawler's event loop): past
+        # queueSize, room is cleared and the crawler stops listing directories
+        self.queue = queue.Queue()
+        self.queueSize = queueSize
+        self.room = Gate()
+        self.thread = None
+        self.submitted = 0
+        self.error = None
+    def start(self):
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+        return self
+    def onFile(self, entry):
+        relpath = entry['url'].removeprefix(self.base)
+        if relpath.split('/', 1)[0] in DEFERRED:
+            return
+        old = self.previous.get(relpath)
+        if old is None or entryChanged(old, entry):
+            self.queue.put(entry)
+            if self.queue.qsize() >= self.queueSize:
+                self.room.clear()
+                # the submitter may have drained the queue meanwhile
+                if self.queue.qsize() < self.queueSize:
+                    self.room.set()
+    def directory(self, url):
+        rel = url.removeprefix(self.base)
+        if '/' not in rel:
+            return str(self.parent)
+        return str(self.parent / rel.rsplit('/', 1)[0])
+    def run(self):
+        done = False
+        while not done:
+            # whatever queued up meanwhile is handed over at once
+            batch = [self.queue.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            if self.queue.qsize() < self.queueSize:
+                self.room.set()
+            # after a failure, keep draining so that the crawler never blocks
+            if self.error is not None or len(batch) == 0:
+                continue
+            try:
+                for entry in batch:
+                    directory = self.directory(entry['url'])
+                    if self.store is not None and self.store.link(entry, Path(directory) / unquote(entry['url'].rsplit('/', 1)[1])):
+                        continue
+                    self.downloader.add(entry['url'], directory)
+                    self.submitted += 1
+                self.downloader.flush()
+            except Exception as e:
+                print('Pipelined downloads stopped: %s' % str(e))
+                self.error = e
+    def close(self):
+        # returns False when the downloads have to be queued after the diff
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.room.set()
+        self.previous = None
+        return self.error is None
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+'''
+Synchronisation of one repository (source + distro): indexing, queueing
+into a downloader shared with the other repositories, verification and
+cleanup of its own tree
+'''
+
+# python 3.9 and onward required
+
+import os
+import json
+from pathlib import Path
+from pathtools import saveIndex, loadIndex, cachePath, indexPath, presentFiles
+from analyse import CrawlState, crawlState_Threaded
+from listcache import ListingCache
+from indexstream import IndexWriter, iterIndexFile, isStreamIndex
+from packedindex import iterIndex, PackedIndex
+from aptindex import aptCrawlState, readAPTMetadata, poolCrawlState, mergePoolStamps
+from verify import verifyIndex, requeueMismatches
+from contentstore import ContentStore
+from journal import StateJournal
+from pipeline import DownloadPipeline, DEFERRED
+from fetch import BATCH_SIZE
+from difftree import diffIndices_MergeJoin, diffIndices_External
+from dicttools import listStat, mergeIndices, iterFiles
+from treeclean import treeCleanup, pathTrim
+from metrics import registry
+
+# downloaded in this order: no "dists" may refer to packages not mirrored yet
+FETCH_STAGES = ['pool', 'dists', '']
+
+class RepositorySync:
+    def __init__(self, generalOpts, downloader, batchSize = BATCH_SIZE, crawler = None, name = ''):
+        self.opts = generalOpts
+        self.downloader = downloader
+        self.batchSize = batchSize
+        # SharedCrawler of the async engine, if any
+        self.crawler = crawler
+        self.name = name
+        # metrics label
+        self.label = name if name != '' else generalOpts.distro
+        self.parent = generalOpts.destination / generalOpts.distro
+        self.store = None
+        if generalOpts.store != '':
+            self.store = ContentStore(generalOpts.store)
+        # files fetched & deleted, recorded in the cache directory
+        self.journal = None
+        if generalOpts.journal:
+            self.journal = StateJournal(cachePath(generalOpts.cache, generalOpts.source, generalOpts.distro, 'state.sqlite'), self.parent)
+        self.newIndex = None
+        self.newFiles = {}
+        self.fetchFiles = {}
+        self.deletedFiles = None
+        self.pipelined = False
+    def log(self, message):
+        if self.name == '':
+            print(message)
+        else:
+            print('[%s] %s' % (self.name, message))
+    def crawlIndex(self, state):
+        if self.crawler is not None:
+            return self.crawler.crawl(state)
+        return crawlState_Threaded(state, self.opts.connections)
+    def index(self):
+        '''Crawls, diffs against the previous index and saves the new one'''
+        gOpts = self.opts
+        # check existing index
+        currIndexPath, prevIndexPath = indexPath(gOpts.cache, gOpts.source, gOpts.distro, gOpts.index_format)
+        stampsPath = cachePath(gOpts.cache, gOpts.source, gOpts.distro, 'stamps.json')
+        currIndex = None
+        currStamps = None
+        oldFiles = None
+        addedFiles = None
+        updatedFiles = None
+        # a streamed index is never loaded, it is diffed out of core unless
+        # incremental crawls need its subtrees
+        lazyIndex = prevIndexPath.is_file() and isStreamIndex(prevIndexPath) and not gOpts.incremental
+        # a packed index is diffed through mmap when only the diff reads it
+        packedIndex = prevIndexPath.suffix == '.hsix' and not gOpts.incremental and not gOpts.pipeline
+        # an index in another format is only replaced once it was read
+        prevRead = False
+        if prevIndexPath.is_file():
+            self.log('Current index is found')
+            try:
+                if packedIndex:
+                    currIndex = PackedIndex(prevIndexPath)
+                elif not lazyIndex:
+                    currIndex = loadIndex(prevIndexPath)
+                prevRead = True
+            except Exception as e:
+                self.log('Failed reading current index: %s' % str(e))
+        if gOpts.incremental and currIndex is not None and stampsPath.is_file():
+            try:
+                with stampsPath.open('r') as f:
+                    currStamps = json.load(f)
+            except Exception as e:
+                self.log('Failed reading directory timestamps, doing full crawl: %s' % str(e))
+        # build index
+        self.log('Building index from source')
+        url = gOpts.source
+        if not url.endswith('/'):
+            url += '/'
+        url += gOpts.distro
+        listingCache = None
+        if gOpts.listing_cache:
+            listingCache = ListingCache(cachePath(gOpts.cache, gOpts.source, gOpts.distro, 'listing.json'))
+        # streamed formats are written while crawling, except with the APT
+        # indexer: Release annotates the "dists" entries once the crawl is over
+        callbacks = []
+        writer = None
+        if isStreamIndex(currIndexPath):
+            writer = IndexWriter(currIndexPath, url + '/')
+            if gOpts.indexer != 'apt':
+                callbacks.append(writer.write)
+        # changed files are downloaded while crawling
+        pipeline = None
+        ready = None
+        if gOpts.pipeline:
+            previous = iterIndexFile(prevIndexPath) if lazyIndex else iterFiles(currIndex)
+            pipeline = DownloadPipeline(self.downloader, url + '/', self.parent, previous, self.batchSize, store = self.store).start()
+            callbacks.append(pipeline.onFile)
+            ready = pipeline.room
+        def onFile(entry):
+            for callback in callbacks:
+                callback(entry)
+        if gOpts.indexer == 'apt':
+            crawl = aptCrawlState(url, gOpts.whitelist, gOpts.blacklist, listingCache, currIndex, currStamps, onFile, ready)
+        else:
+            crawl = CrawlState(url, gOpts.whitelist, gOpts.blacklist, listingCache, currIndex, currStamps, onFile, ready)
+        with registry.timer('stage_duration_seconds', repository = self.label, stage = 'crawl'):
+            newIndex = self.crawlIndex(crawl)
+            if gOpts.indexer == 'apt':
+                self.log('Indexing "pool" from APT metadata')
+                pool = readAPTMetadata(crawl, gOpts.whitelist, gOpts.blacklist, gOpts.connections)
+                if pool is None:
+                    self.log('APT metadata unusable, crawling "pool" instead')
+                    poolState = poolCrawlState(crawl, gOpts.whitelist, gOpts.blacklist, listingCache, onFile, ready)
+                    poolIndex = self.crawlIndex(poolState)
+                    mergePoolStamps(crawl, poolState)
+                    if len(poolIndex) > 0:
+                        newIndex['pool'] = poolIndex
+                else:
+                    for entry in pool.values():
+                        crawl.addFile(entry)
+                    self.log('Files listed by APT metadata: %d' % len(pool))
+        if writer is not None and gOpts.indexer == 'apt':
+            for relpath, entry in iterIndex(newIndex):
+                writer.write(entry)
+        self.pipelined = pipeline is not None and pipeline.close()
+        if listingCache is not None:
+            self.log('Unchanged listings reused from cache: %d' % listingCache.hits)
+            listingCache.save()
+        if currStamps is not None:
+            self.log('Unchanged directories skipped: %d' % crawl.pruned)
+        # - build diff index (add & remove)
+        if currIndex is None and not lazyIndex:
+            newFiles = newIndex
+            addedFiles = newIndex
+        else:
+            self.log('Comparing for changes')
+            # - categorise files update/add/delete
+            with registry.timer('stage_duration_seconds', repository = self.label, stage = 'diff'):
+                if lazyIndex and gOpts.diff_memory > 0:
+                    diff = diffIndices_External(iterIndexFile(prevIndexPath), newIndex, gOpts.cache / 'tmp', gOpts.diff_memory << 20)
+                elif lazyIndex:
+                    diff = diffIndices_External(iterIndexFile(prevIndexPath), newIndex, gOpts.cache / 'tmp')
+                elif gOpts.diff_memory > 0:
+                    diff = diffIndices_External(currIndex, newIndex, gOpts.cache / 'tmp', gOpts.diff_memory << 20)
+                else:
+                    diff = diffIndices_MergeJoin(currIndex, newIndex)
+            if type(currIndex) is PackedIndex:
+                # unmapped before the new index replaces the file
+                currIndex.close()
+            addedFiles   = diff['added']
+            self.deletedFiles = diff['deleted']
+            updatedFiles = diff['updated']
+            newFiles = mergeIndices(addedFiles, updatedFiles)
+            oldFiles = listStat(self.deletedFiles) + listStat(updatedFiles)
+        # save new index
+        if writer is not None:
+            writer.close()
+        else:
+            saveIndex(newIndex, currIndexPath)
+        if prevIndexPath != currIndexPath:
+            if prevRead:
+                os.remove(str(prevIndexPath))
+            else:
+                self.log('Unreadable index left in place: %s' % str(prevIndexPath))
+        saveIndex(crawl.stampsIndex(), stampsPath)
+        # statistics
+        self.log('Summary:')
+        self.log(' - New files: %d' % listStat(newFiles))
+        if oldFiles is not None:
+            self.log(' - Old files: %d' % oldFiles)
+        self.log(' - Files to be added: %d' % listStat(addedFiles))
+        if self.deletedFiles is not None:
+            self.log(' - Files to be deleted: %d' % listStat(self.deletedFiles))
+        if updatedFiles is not None:
+            self.log(' - Files to be updated: %d' % listStat(updatedFiles))
+        # files gone from the tree since the last run, known without a rescan
+        missing = {}
+        if self.journal is not None and self.journal.reconciled() is not None and oldFiles is not None:
+            missing = self.journal.missingIndex(newIndex, newFiles)
+            if len(missing) > 0:
+                self.log(' - Files missing from the tree: %d' % listStat(missing))
+                newFiles = mergeIndices(newFiles, missing)
+        registry.set('index_files', listStat(newIndex), repository = self.label)
+        registry.set('changed_files', listStat(addedFiles), repository = self.label, kind = 'added')
+        registry.set('changed_files', listStat(self.deletedFiles), repository = self.label, kind = 'deleted')
+        registry.set('changed_files', listStat(updatedFiles), repository = self.label, kind = 'updated')
+        registry.set('changed_files', listStat(missing), repository = self.label, kind = 'missing')
+        self.newIndex = newIndex
+        self.newFiles = newFiles
+        if self.pipelined:
+            self.log('Added %d files to downloads while crawling' % pipeline.submitted)
+            # newFiles already holds the missing files of DEFERRED directories
+            self.fetchFiles = dict((key, missing[key]) for key in missing.keys() if key not in DEFERRED)
+            for key in DEFERRED:
+                if key in newFiles:
+                    self.fetchFiles[key] = newFiles[key]
+        else:
+            self.fetchFiles = newFiles
+        if self.store is not None:
+            self.fetchFiles = self.store.linkIndex(self.fetchFiles, self.parent)
+    def stage(self, stage):
+        # (subindex, parent) of a fetch stage; '' is everything but "pool" & "dists"
+        if stage != '':
+            if stage in self.fetchFiles:
+                return [(self.fetchFiles[stage], self.parent / stage)]
+            return []
+        directories = []
+        for key in self.fetchFiles.keys():
+            if key in FETCH_STAGES:
+                continue
+            elif key == 'files':
+                directories.append(({ key : self.fetchFiles[key] }, self.parent))
+            else:
+                directories.append((self.fetchFiles[key], self.parent / key))
+        return directories
+    def queueStage(self, stage):
+        count = 0
+        for index, parent in self.stage(stage):
+            count += self.downloader.addIndex(index, parent)
+        return count
+    def verify(self):
+        '''Re-queues mismatching files; returns their number'''
+        gOpts = self.opts
+        if gOpts.verify == 'off':
+            return 0
+        self.log('Verifying checksums')
+        statePath = None
+        if gOpts.verify == 'incremental':
+            statePath = cachePath(gOpts.cache, gOpts.source, gOpts.distro, 'verified.json')
+        with registry.timer('stage_duration_seconds', repository = self.label, stage = 'verify'):
+            mismatched = verifyIndex(self.newIndex, self.parent, gOpts.connections, statePath)
+        if listStat(mismatched) == 0:
+            return 0
+        count = requeueMismatches(self.downloader, mismatched, self.parent)
+        self.log('Re-downloading %d mismatching files' % count)
+        return count
+    def cleanup(self, dryRun = False, reconcile = False):
+        gOpts = self.opts
+        synced = presentFiles(self.newFiles, self.parent)
+        registry.count('synced_files', synced[0], repository = self.label)
+        registry.count('synced_bytes', synced[1], repository = self.label)
+        if self.journal is not None:
+            self.log('Fetched files recorded in the state journal: %d' % self.journal.recordIndex(self.newFiles))
+        if self.store is not None:
+            self.log('Files linked from the content store: %d' % self.store.linked)
+            self.log('Files added to the content store: %d' % self.store.ingestIndex(self.newFiles, self.parent))
+        # remove old files
+        with registry.timer('stage_duration_seconds', repository = self.label, stage = 'cleanup'):
+            treeCleanup(self.deletedFiles, Path(gOpts.destination) / gOpts.distro)
+        if self.journal is not None:
+            self.journal.forgetIndex(self.deletedFiles)
+        # triming excesses
+        with registry.timer('stage_duration_seconds', repository = self.label, stage = 'trim'):
+            pathTrim(gOpts.destination, gOpts.distro, gOpts.source, self.newIndex, gOpts.cache, dryRun, journal = self.journal, reconcile = reconcile)
+        if self.journal is not None:
+            self.journal.close()
+        if self.store is not None:
+            self.log('Unreferenced files removed from the content store: %d' % self.store.prune())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+'''
+asyncfetch against a local http.server fixture: full downloads, resumed
+partial files (Range + If-Range), files changed upstream and atomic renames
+
+Run: python -m pytest tests (or python -m unittest discover -s tests -t .)
+'''
+
+# python 3.9 and onward required
+
+import json
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+import http.server
+from pathlib import Path
+from asyncfetch import createSession, downloadFile_Async, PART_SUFFIX, VALIDATOR_SUFFIX
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    '''Serves server.files ({ path : (data, etag) }) with Range & If-Range;
+    server.cut bytes into the next response the connection is dropped'''
+    protocol_version = 'HTTP/1.1'
+    def log_message(self, *args):
+        pass
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        data, etag = self.server.files[self.path]
+        ranged = self.headers.get('Range')
+        # a changed file (If-Range mismatch) is sent whole
+        if ranged is not None and self.headers.get('If-Range', etag) == etag:
+            start = int(ranged.removeprefix('bytes=').split('-', 1)[0]) - self.server.skew
+            body = data[start:]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', '%d' % len(body))
+        self.end_headers()
+        if self.server.cut is not None:
+            self.wfile.write(body[:self.server.cut])
+            self.server.cut = None
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+class AsyncFetchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.daemon_threads = True
+        self.server.files = {}
+        self.server.requests = []
+        self.server.cut = None
+        self.server.skew = 0
+        self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.dir = Path(tempfile.mkdtemp(prefix = 'httpsync-test-'))
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(str(self.dir), ignore_errors = True)
+    def serve(self, name, data, etag):
+        self.server.files['/' + name] = (data, etag)
+        return self.url + '/' + name
+    def download(self, url, path, retries = 1):
+        async def run():
+            async with createSession(2) as session:
+                return await downloadFile_Async(session, url, path, retries)
+        return asyncio.run(run())
+    def leftovers(self, path):
+        return [p.name for p in [path.with_name(path.name + PART_SUFFIX), path.with_name(path.name + VALIDATOR_SUFFIX)] if p.exists()]
+    def test_full_download(self):
+        data = bytes(range(256)) * 1000
+        path = self.dir / 'Packages'
+        self.assertTrue(self.download(self.serve('Packages', data, '"v1"'), path))
+        self.assertEqual(path.read_bytes(), data)
+        self.assertEqual(self.leftovers(path), [])
+    def test_interrupted_download_is_resumed(self):
+        data = bytes(range(256)) * 1000
+        url = self.serve('Packages', data, '"v1"')
+        path = self.dir / 'Packages'
+        self.server.cut = 100000
+        self.assertFalse(self.download(url, path))
+        # nothing is renamed into place before the file is complete
+        self.assertFalse(path.exists())
+        self.assertEqual(self.leftovers(path), ['Packages' + PART_SUFFIX, 'Packages' + VALIDATOR_SUFFIX])
+        self.assertTrue(self.download(url, path))
+        self.assertEqual(self.server.requests[-1].get('Range'), 'bytes=100000-')
+        self.assertEqual(self.server.requests[-1].get('If-Range'), '"v1"')
+        self.assertEqual(path.read_bytes(), data)
+        self.assertEqual(self.leftovers(path), [])
+    def test_changed_file_is_not_joined(self):
+        old = b'a' * 50000
+        new = b'b' * 80000
+        url = self.serve('Packages', old, '"v1"')
+        path = self.dir / 'Packages'
+        self.server.cut = 20000
+        self.assertFalse(self.download(url, path))
+        self.serve('Packages', new, '"v2"')
+        self.assertTrue(self.download(url, path))
+        self.assertEqual(path.read_bytes(), new)
+    def test_partial_file_without_validator_restarts(self):
+        data = b'c' * 30000
+        url = self.serve('Packages', data, '"v1"')
+        path = self.dir / 'Packages'
+        path.with_name(path.name + PART_SUFFIX).write_bytes(b'x' * 1000)
+        self.assertTrue(self.download(url, path))
+        self.assertNotIn('Range', self.server.requests[-1])
+        self.assertEqual(path.read_bytes(), data)
+    def test_misplaced_content_range_is_rejected(self):
+        data = bytes(range(256)) * 100
+        url = self.serve('Packages', data, '"v1"')
+        path = self.dir / 'Packages'
+        part = path.with_name(path.name + PART_SUFFIX)
+        part.write_bytes(data[:5000])
+        path.with_name(path.name + VALIDATOR_SUFFIX).write_text(json.dumps({ 'etag' : '"v1"', 'last_modified' : None }))
+        # the server answers 206 from another offset than requested
+        self.server.skew = 10
+        self.assertFalse(self.download(url, path))
+        self.assertFalse(path.exists())
+        self.assertFalse(part.exists())
+        self.server.skew = 0
+        self.assertTrue(self.download(url, path))
+        self.assertEqual(path.read_bytes(), data)
+
+if __name__ == '__main__':
+    unittest.main()
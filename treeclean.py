@@ -4,56 +4,55 @@ Cleanup the destination to match the current index
 '''
 
 import json
+import tempfile
 from pathlib import Path
-from pathtools import directoryIndex, fileCleanup, saveIndex
-from difftree import diffIndices_Threaded
-from dicttools import listStat, transverseDict, filesTree
+from pathtools import directoryIndex, filesCleanup, indexFiles, saveIndex, cachePath
+from difftree import diffIndices_MergeJoin, diffIndices_External
+from packedindex import PackedIndex
+from dicttools import listStat
+from metrics import registry
 
-def pathIndex(dest, distro, src_url):
+def pathURL(src_url, distro):
     url = str(src_url)
     if not url.endswith('/'):
         url += '/'
-    url += distro + '/'
-    p = Path(dest) / distro
-    return directoryIndex(p, url)
+    return url + distro + '/'
+
+def pathIndex(dest, distro, src_url):
+    return directoryIndex(Path(dest) / distro, pathURL(src_url, distro))
 
-def treeCleanup(index, parent):
-    if index is not None:
-        delPaths = filesTree(index)
-        delList = []
-        for subdirs in delPaths:
-            p = Path(parent)
-            for subdir in subdirs:
-                if subdir != 'files':
-                    p /= subdir
-            for file in transverseDict(index, subdirs):
-                url = str(file['url']).rsplit('/', maxsplit=1)
-                delList.append(p / url[1])
-        for delFile in delList:
-            print('Deleting tree: %s' % str(delFile))
-            fileCleanup(delFile)
+def treeCleanup(index, parent, maxThreads = 4):
+    # returns (files, bytes, directories) removed
+    if index is None:
+        return (0, 0, 0)
+    delList = [path for entry, path in indexFiles(index, parent)]
+    for delFile in delList:
+        print('Deleting tree: %s' % str(delFile))
+    with registry.timer('cleanup_duration_seconds'):
+        removed = filesCleanup(delList, parent, maxThreads)
+    registry.count('deleted_files', removed[0])
+    registry.count('deleted_bytes', removed[1])
+    registry.count('deleted_directories', removed[2])
+    print('Deleted %d files (%.1f MiB), %d empty directories' % (removed[0], removed[1] / (1 << 20), removed[2]))
+    return removed
 
-def pathTrim(dest, distro, src_url, index, save_path = None, dry_run = False, use_cached = False):
+def pathTrim(dest, distro, src_url, index, save_path = None, dry_run = False, use_cached = False, journal = None, reconcile = False):
     dIndex = None
     p = None
+    # a reconciled state journal knows the destination without a scan
+    fromJournal = journal is not None and not reconcile and journal.reconciled() is not None
     if save_path is not None:
-        srcname = str(src_url)
-        if srcname.find('https') == 0:
-            srcname = srcname.removeprefix('https://')
-        else:
-            srcname = srcname.removeprefix('http://')
-        if srcname.endswith('/'):
-            srcname = srcname.removesuffix('/')
-        if srcname.find('/') >= 0:
-            srcsplit = srcname.split('/')
-            srcname = '_'.join(srcsplit)
-        p = Path(save_path) / str(srcname + '_' + distro + '_dir.json')
+        p = cachePath(save_path, src_url, distro, 'dir.json')
     if use_cached and not p.is_file():
         use_cached = False
         if p.is_dir():
             save_path = None
             p = None
-    if use_cached:
+    if fromJournal:
+        print('Using the state journal (%d files)' % journal.count())
+        dIndex = journal.pathIndex(pathURL(src_url, distro))
+        use_cached = True
+    elif use_cached:
         print('Using previously scanned directory structure')
         try:
             with p.open('r') as f:
@@ -64,9 +63,16 @@ def pathTrim(dest, distro, src_url, index, save_path = None, dry_run = False, us
     if not use_cached:
         print('Scanning destination (may take a while): %s' % str(Path(dest) / distro))
         dIndex = pathIndex(dest, distro, src_url)
+        if journal is not None:
+            print('State journal reconciled: %d files' % journal.reconcile(dIndex, pathURL(src_url, distro)))
     print('Comapring to source structure')
-    excess  = diffIndices_Threaded(index, dIndex, urlOnly = True)
-    missing = diffIndices_Threaded(dIndex, index, urlOnly = True)
+    if type(index) is dict or isinstance(index, PackedIndex):
+        diff = diffIndices_MergeJoin(index, dIndex, pathOnly = True)
+    else:
+        # an index stream (iterIndexFile) is in crawl order: sorted out of core
+        diff = diffIndices_External(index, dIndex, Path(save_path if save_path is not None else tempfile.gettempdir()) / 'tmp', pathOnly = True)
+    excess  = diff['added']
+    missing = diff['deleted']
     print('Summary:')
     print(' - Excesses: %d' % listStat(excess))
     print(' - Not downloaded or failed: %d' % listStat(missing))
@@ -79,4 +85,6 @@ def pathTrim(dest, distro, src_url, index, save_path = None, dry_run = False, us
     if not dry_run:
         print('Deleting')
         treeCleanup(excess, Path(dest) / distro)
+        if journal is not None:
+            journal.forgetIndex(excess)
         print('Done')
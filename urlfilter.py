@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+'''
+Compiled include/exclude filter with subtree pruning for the crawler
+'''
+
+# python 3.9 and onward required
+
+import re
+
+REGEX_META = '.^$*+?{}[]|()\\'
+REGEX_QUANTIFIERS = '*+?{'
+LITERAL_ESCAPES = '.^$*+?{}[]|()\\/-_:~ '
+
+LEADING_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+class PatternList:
+    '''Separately compiled patterns, for those which cannot be merged'''
+    def __init__(self, regexes):
+        self.patterns = [re.compile(regex) for regex in regexes]
+    def search(self, string):
+        for pattern in self.patterns:
+            match = pattern.search(string)
+            if match is not None:
+                return match
+        return None
+
+def scopedGroup(regex):
+    # global flags are only allowed at the start: "(?i)bash" -> "(?i:bash)"
+    m = LEADING_FLAGS.match(regex)
+    if m is None:
+        return '(?:%s)' % regex
+    return '(?%s:%s)' % (m.group(1), regex[m.end():])
+
+def compileAlternation(regexes):
+    if len(regexes) == 0:
+        return None
+    # groups are renumbered once merged: backreferences need their own pattern
+    if any(BACKREFERENCE.search(regex) is not None for regex in regexes):
+        return PatternList(regexes)
+    try:
+        return re.compile('|'.join(scopedGroup(regex) for regex in regexes))
+    except re.error:
+        return PatternList(regexes)
+
+# literal text every match of a '^'-anchored pattern starts with,
+# None when the pattern may match anywhere in the URL
+def anchoredPrefix(regex):
+    if not regex.startswith('^'):
+        return None
+    literal = ''
+    pos = 1
+    depth = 0
+    # top-level alternation defeats the anchor
+    escaped = False
+    for char in regex:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return None
+    while pos < len(regex):
+        char = regex[pos]
+        if char == '\\' and pos + 1 < len(regex) and regex[pos + 1] in LITERAL_ESCAPES:
+            char = regex[pos + 1]
+            step = 2
+        elif char in REGEX_META:
+            break
+        else:
+            step = 1
+        # a quantified character is not required
+        if pos + step < len(regex) and regex[pos + step] in REGEX_QUANTIFIERS:
+            break
+        literal += char
+        pos += step
+    return literal
+
+class URLFilter:
+    def __init__(self, whitelist = [], blacklist = []):
+        self.whitelist = compileAlternation(whitelist)
+        self.blacklist = compileAlternation(blacklist)
+        self.prefixes = [anchoredPrefix(regex) for regex in whitelist]
+        # any unanchored include pattern may match under every directory
+        self.prunable = len(whitelist) > 0 and None not in self.prefixes
+    def matchFile(self, url):
+        if self.whitelist is not None and self.whitelist.search(url) is None:
+            return False
+        if self.blacklist is not None and self.blacklist.search(url) is not None:
+            return False
+        return True
+    def matchDir(self, url):
+        # can anything under this directory be included?
+        if self.blacklist is not None and self.blacklist.search(url) is not None:
+            return False
+        if not self.prunable or self.whitelist.search(url) is not None:
+            return True
+        for prefix in self.prefixes:
+            if prefix.startswith(url) or url.startswith(prefix):
+                return True
+        return False
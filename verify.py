@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+'''
+Checksum verification of the mirrored files against the SHA256 sums
+from the APT metadata (entries carrying a "sha256" key)
+'''
+
+# python 3.9 and onward required
+
+import os
+import json
+import mmap
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from dicttools import filesTree, transverseDict
+
+# large files are hashed through a memory map, small ones through one buffer
+MMAP_THRESHOLD = 4 << 20
+BUFFER_SIZE = 1 << 20
+
+def hashFile(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+                h.update(m)
+        else:
+            buffer = bytearray(BUFFER_SIZE)
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                h.update(view[:n])
+    return h.hexdigest()
+
+# (relative path, entry) of every entry that can be verified
+def checkedEntries(index):
+    for path in filesTree(index):
+        parent = '/'.join(path[:-1])
+        for entry in transverseDict(index, path):
+            if 'sha256' in entry:
+                name = entry['url'].rsplit('/', 1)[1]
+                yield (parent + '/' + name) if parent != '' else name, path, entry
+
+def verifyFile(parent, relpath, entry, verified):
+    # returns (ok, state record)
+    p = Path(parent) / relpath
+    try:
+        st = p.stat()
+    except OSError:
+        return False, None
+    if '%d' % st.st_size != entry['file']:
+        return False, None
+    record = [st.st_size, st.st_mtime_ns, entry['sha256']]
+    # incremental: unchanged since it was last verified against the same sum
+    if verified is not None and verified.get(relpath) == record:
+        return True, record
+    if hashFile(str(p)) != entry['sha256']:
+        return False, None
+    return True, record
+
+def verifyIndex(index, parent, maxThreads = 4, state_path = None):
+    '''Hashes the files of index under parent; returns the mismatching
+    (or missing) entries as an index. With state_path, files whose size and
+    mtime did not change since the last verified run are not hashed again.'''
+    verified = None
+    if state_path is not None:
+        verified = {}
+        p = Path(state_path)
+        if p.is_file():
+            try:
+                with p.open('r') as f:
+                    verified = json.load(f)
+            except Exception as e:
+                print('Cannot read verification state, verifying everything: %s' % str(e))
+    mismatched = {}
+    records = {}
+    entries = list(checkedEntries(index))
+    with ThreadPoolExecutor(max_workers = maxThreads) as executor:
+        results = executor.map(lambda item: verifyFile(parent, item[0], item[2], verified), entries)
+        for (relpath, path, entry), (ok, record) in zip(entries, results):
+            if ok:
+                records[relpath] = record
+                continue
+            vect = mismatched
+            for key in path[:-1]:
+                if key not in vect:
+                    vect[key] = {}
+                vect = vect[key]
+            if 'files' not in vect:
+                vect['files'] = []
+            vect['files'].append(entry)
+    if state_path is not None:
+        tmp = Path(str(state_path) + '.tmp')
+        with tmp.open('w') as f:
+            json.dump(records, f)
+        os.replace(str(tmp), str(state_path))
+    return mismatched
+
+def requeueMismatches(downloader, mismatched, parent):
+    # drop the corrupt copies so they are not kept (or renamed) by the downloader
+    for relpath, path, entry in checkedEntries(mismatched):
+        try:
+            os.remove(str(Path(parent) / relpath))
+        except OSError:
+            pass
+    return downloader.addIndex(mismatched, Path(parent))